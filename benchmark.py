@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+from __future__ import print_function, division
+import json
+import os
+import random
+import string
+import tempfile
+import time
+import numpy as np
+from q1 import ColorMap, LabelColorMap
+from q3 import SubstitutionCipherSolver
+
+__author__ = 'Ben Lai'
+__email__ = "laichunpongben@gmail.com"
+
+
+class Benchmark(object):
+    '''
+    Benchmark the genetic algorithm solvers on seeded synthetic problems:
+    random planar region maps of growing size for ColorMap and
+    random substitution ciphers over a corpus for SubstitutionCipherSolver.
+    Each run reports generations, evaluations, seconds and success;
+    each problem size is summarized by generations/sec, evaluations/sec,
+    mean time to solution and success rate.
+    '''
+
+    MAP_CHARS = string.digits + string.ascii_letters
+
+    def __init__(self, **kwargs):
+        self.seeds = kwargs.get('seeds', 5)
+        self.solver_kwargs = kwargs.get('solver_kwargs', {})
+        self.results = []
+
+    @staticmethod
+    def random_region_labels(regions, seed, cell_size=4):
+        '''
+        Voronoi regions of random sites on a square grid,
+        which are connected and form a planar adjacency graph.
+        '''
+        rng = np.random.RandomState(seed)
+        side = max(int(np.ceil(np.sqrt(regions))) * cell_size, 2)
+        sites = rng.choice(side * side, regions, replace=False)
+        site_y, site_x = np.divmod(sites, side)
+        labels = np.empty((side, side), dtype=np.int32)
+        x = np.arange(side)
+        for y in range(side):
+            distances = (site_y[:, np.newaxis] - y) ** 2 + (site_x[:, np.newaxis] - x) ** 2
+            labels[y] = distances.argmin(axis=0)
+        return labels
+
+    def write_region_map(self, regions, seed, folder):
+        labels = self.random_region_labels(regions, seed)
+        if regions <= len(self.MAP_CHARS):
+            path = os.path.join(folder, 'map_{0}_{1}.txt'.format(regions, seed))
+            chars = np.array([ord(c) for c in self.MAP_CHARS], dtype=np.uint8)
+            rows = [row.tobytes().decode('ascii') for row in chars[labels]]
+            ColorMap.save(ColorMap.normalize_map(rows), path)
+            return ColorMap, path
+        path = os.path.join(folder, 'map_{0}_{1}.npy'.format(regions, seed))
+        np.save(path, labels)
+        return LabelColorMap, path
+
+    @staticmethod
+    def random_cipher(corpus_words, length, seed):
+        rng = random.Random(seed)
+        words = [rng.choice(corpus_words) for _ in range(length)]
+        key = ''.join(rng.sample(string.ascii_lowercase, len(string.ascii_lowercase)))
+        plain_text = ' '.join(words)
+        cipher_text = plain_text.translate(str.maketrans(string.ascii_lowercase, key))
+        return cipher_text, plain_text, sorted(list(set(words)))
+
+    def run(self, problem, size, seed, solve):
+        random.seed(seed)
+        start = time.time()
+        solver, succeeded = solve()
+        seconds = time.time() - start
+        result = {
+            'problem': problem,
+            'size': size,
+            'seed': seed,
+            'generations': getattr(solver, 'generation', 0),
+            'evaluations': getattr(solver, 'evaluations', 0),
+            'seconds': seconds,
+            'success': succeeded,
+        }
+        self.results.append(result)
+        return result
+
+    def bench_color_map(self, sizes, method='ga'):
+        with tempfile.TemporaryDirectory() as folder:
+            for size in sizes:
+                for seed in range(self.seeds):
+                    color_map_class, path = self.write_region_map(size, seed, folder)
+
+                    def solve():
+                        color_map = color_map_class(path, **self.solver_kwargs)
+                        _, fitness, _ = color_map.solve(method)
+                        return color_map, fitness >= color_map.success_threshold
+
+                    self.run('color_map/{0}'.format(method), size, seed, solve)
+        return self.summarize()
+
+    def bench_cipher(self, corpus_words, sizes, method='ga'):
+        for size in sizes:
+            for seed in range(self.seeds):
+                cipher_text, plain_text, words = self.random_cipher(corpus_words, size, seed)
+
+                def solve():
+                    solver = SubstitutionCipherSolver(cipher_text, words, **self.solver_kwargs)
+                    key, _ = solver.solve(method)
+                    return solver, solver.decrypt(key, cipher_text) == plain_text
+
+                self.run('cipher/{0}'.format(method), size, seed, solve)
+        return self.summarize()
+
+    def summarize(self):
+        groups = {}
+        for result in self.results:
+            groups.setdefault((result['problem'], result['size']), []).append(result)
+
+        summaries = []
+        for (problem, size), results in sorted(groups.items()):
+            seconds = sum(result['seconds'] for result in results)
+            solved = [result['seconds'] for result in results if result['success']]
+            summaries.append({
+                'problem': problem,
+                'size': size,
+                'runs': len(results),
+                'generations_per_second': sum(result['generations'] for result in results) / seconds,
+                'evaluations_per_second': sum(result['evaluations'] for result in results) / seconds,
+                'time_to_solution': sum(solved) / len(solved) if solved else None,
+                'success_rate': len(solved) / len(results),
+            })
+        return summaries
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump({'summaries': self.summarize(), 'results': self.results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the genetic algorithm solvers.')
+    parser.add_argument('problem', choices=['color_map', 'cipher'],
+                        help='solver to benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 20, 40],
+                        help='number of regions or cipher words')
+    parser.add_argument('--seeds', type=int, default=5,
+                        help='seeded runs per size')
+    parser.add_argument('--method', default='ga',
+                        help='solve method of the solver')
+    parser.add_argument('--dict', default='q3/dict.txt',
+                        help='corpus of words for random ciphers')
+    parser.add_argument('--output', default='bench_output.json',
+                        help='path of the machine-readable results')
+
+    args = parser.parse_args()
+
+    benchmark = Benchmark(seeds=args.seeds)
+    if args.problem == 'color_map':
+        summaries = benchmark.bench_color_map(args.sizes, args.method)
+    else:
+        with open(args.dict, 'r') as f:
+            corpus_words = sorted(list(set(f.read().strip().split(' '))))
+        summaries = benchmark.bench_cipher(corpus_words, args.sizes, args.method)
+
+    for summary in summaries:
+        print(summary)
+    benchmark.save(args.output)
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+from __future__ import print_function, division
+import os
+import pickle
+import random
+import time
+import zlib
+from collections import OrderedDict
+
+__author__ = 'Ben Lai'
+__email__ = "laichunpongben@gmail.com"
+
+
+class NullTelemetry(object):
+    '''
+    Default telemetry of the genetic algorithm solvers, which records nothing.
+    '''
+
+    records = ()
+
+    def start(self, generation, evaluations):
+        pass
+
+    def detach(self):
+        '''
+        Fresh telemetry of the same kind without callback,
+        whose records a worker process sends back for replay.
+        '''
+        return NullTelemetry()
+
+    def replay(self, record):
+        pass
+
+    def sample(self, generation):
+        return False
+
+    def record(self, generation, best_chromosome, best_fitness, mean_fitness, evaluations):
+        pass
+
+
+class GenerationTelemetry(NullTelemetry):
+    '''
+    Record per-generation metrics of a genetic algorithm solver
+    every n generations: generation index, best and mean fitness,
+    seconds per generation and evaluations per second since the last record.
+    Records are kept in self.records and passed to callback if given.
+    '''
+
+    def __init__(self, every=1, callback=None):
+        self.every = every
+        self.callback = callback
+        self.records = []
+        self.last_time = None
+        self.last_generation = 0
+        self.last_evaluations = 0
+
+    def start(self, generation, evaluations):
+        self.last_time = time.time()
+        self.last_generation = generation
+        self.last_evaluations = evaluations
+
+    def sample(self, generation):
+        return generation % self.every == 0
+
+    def record(self, generation, best_chromosome, best_fitness, mean_fitness, evaluations):
+        now = time.time()
+        seconds = max(now - self.last_time, 1e-9)
+        generations = max(generation + 1 - self.last_generation, 1)
+        record = {
+            'generation': generation,
+            'best_chromosome': best_chromosome,
+            'best_fitness': best_fitness,
+            'mean_fitness': mean_fitness,
+            'seconds_per_generation': seconds / generations,
+            'evaluations_per_second': (evaluations - self.last_evaluations) / seconds,
+        }
+        self.last_time = now
+        self.last_generation = generation + 1
+        self.last_evaluations = evaluations
+        self.replay(record)
+
+    def detach(self):
+        return GenerationTelemetry(self.every)
+
+    def replay(self, record):
+        self.records.append(record)
+        if self.callback is not None:
+            self.callback(record)
+
+    @staticmethod
+    def print_record(record):
+        print('Generation {generation}: {best_chromosome} {best_fitness}'.format(**record))
+
+
+class FitnessCache(object):
+    '''
+    Bounded LRU cache of fitness by chromosome,
+    so that survivors carried over to the next generation are not rescored.
+    A maxsize of 0 disables caching.
+    '''
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chromosome, compute):
+        try:
+            fitness = self.cache[chromosome]
+        except KeyError:
+            self.misses += 1
+            fitness = compute(chromosome)
+            if self.maxsize:
+                self.cache[chromosome] = fitness
+                if len(self.cache) > self.maxsize:
+                    self.cache.popitem(last=False)
+            return fitness
+        self.hits += 1
+        self.cache.move_to_end(chromosome)
+        return fitness
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+            'size': len(self.cache),
+        }
+
+
+def save_checkpoint(path, state):
+    '''
+    Write the solver state together with the random module state
+    as a zlib-compressed pickle. The file is replaced atomically
+    so that a job killed while writing keeps its previous checkpoint.
+    '''
+    state = dict(state, random_state=random.getstate())
+    data = zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL))
+    temp_path = '{0}.tmp'.format(path)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def load_checkpoint(path):
+    '''
+    Read a checkpoint written by save_checkpoint,
+    restore the random module state and return the solver state.
+    '''
+    with open(path, 'rb') as f:
+        state = pickle.loads(zlib.decompress(f.read()))
+    random.setstate(state.pop('random_state'))
+    return state
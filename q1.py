@@ -1,7 +1,11 @@
 #!/usr/bin/python3
 
 from __future__ import print_function, division
+import heapq
+import multiprocessing
 import random
+import numpy as np
+from ga_utils import NullTelemetry, GenerationTelemetry, FitnessCache, save_checkpoint, load_checkpoint
 
 __author__ = 'Ben Lai'
 __email__ = "laichunpongben@gmail.com"
@@ -14,7 +18,8 @@ class ColorMap(object):
     By the four color theorem, there exists at least one solution.
     If the coloring is not found in a run,
     try re-run with different parameters
-    such as chromosome_size and max_no_update_generation.
+    such as chromosome_size and max_no_update_generation,
+    or use solve(method='dsatur') or solve(method='min_conflicts').
     '''
 
     COLORS = ['+', '-', '*', '/']
@@ -25,13 +30,34 @@ class ColorMap(object):
         self.max_no_update_generation = kwargs.get('max_no_update_generation', 500)
         self.success_threshold = kwargs.get('success_threshold', 1.0)
         self.mutation_ratio = kwargs.get('mutation_ratio', 0.1)
+        self.max_steps = kwargs.get('max_steps', 100000)
+        self.max_nodes = kwargs.get('max_nodes', None)  # 4 assignments per block if None
+        self.noise_ratio = kwargs.get('noise_ratio', 0.1)
+        self.islands = kwargs.get('islands', 4)
+        self.processes = kwargs.get('processes', None)
+        self.migration_interval = kwargs.get('migration_interval', 50)
+        self.migration_size = kwargs.get('migration_size', 2)
+        self.stop_event = kwargs.get('stop_event', None)
+        self.telemetry = kwargs.get('telemetry', NullTelemetry())
+        self.checkpoint_path = kwargs.get('checkpoint_path', None)
+        self.checkpoint_every = kwargs.get('checkpoint_every', 100)
+        self.fitness_cache = FitnessCache(kwargs.get('fitness_cache_size', 10000))
         self.map = self.load_map(map_path)
         self.height = len(self.map)
         self.width = len(self.map[0])
         self.blocks = self.get_blocks()
         self.adjacency = self.get_adjacency()
+        self.edges = self.get_edges()
+        self.neighbors = self.get_neighbors()
         self.chromosomes = self.init_chromosomes()
+        self.best_chromosome = self.COLORS[0] * len(self.blocks)
+        self.best_fitness = 0.0
+        self.generation = 0
         self.last_updated_generation = 0
+        self.evaluations = 0
+        self.numpy_rng_state = None
+        self.island_states = None
+        self.island_finished = None
 
     @staticmethod
     def load_map(map_path):
@@ -53,6 +79,19 @@ class ColorMap(object):
                     adjacency.append(tuple(sorted([self.map[y][x], self.map[y+1][x]])))
         return sorted(list(set(adjacency)))
 
+    def get_edges(self):
+        index = dict((block, i) for i, block in enumerate(self.blocks))
+        edges0 = np.array([index[block0] for block0, _ in self.adjacency], dtype=np.intp)
+        edges1 = np.array([index[block1] for _, block1 in self.adjacency], dtype=np.intp)
+        return edges0, edges1
+
+    def get_neighbors(self):
+        neighbors = [[] for _ in self.blocks]
+        for index0, index1 in zip(*self.edges):
+            neighbors[index0].append(int(index1))
+            neighbors[index1].append(int(index0))
+        return neighbors
+
     def random_chromosome(self):
         return ''.join([random.choice(self.COLORS) for _ in range(len(self.blocks))])
 
@@ -63,6 +102,9 @@ class ColorMap(object):
         return dict(zip(self.blocks, chromosome))
 
     def fitness(self, chromosome):
+        return self.fitness_cache.get(chromosome, self.compute_fitness)
+
+    def compute_fitness(self, chromosome):
         d = self.get_block_color_dict(chromosome)
         count = 0
         for block0, block1 in self.adjacency:
@@ -70,13 +112,44 @@ class ColorMap(object):
                 count += 1
         return count / len(self.adjacency)
 
+    def conflicts(self, chromosome):
+        d = self.get_block_color_dict(chromosome)
+        count = 0
+        for block0, block1 in self.adjacency:
+            if d[block0] == d[block1]:
+                count += 1
+        return count
+
+    def delta_conflicts(self, chromosome, child_chromosome, changes):
+        '''
+        Change in the number of same-colored adjacent blocks from chromosome to child_chromosome,
+        looking only at the edges of the changed genes.
+        '''
+        delta = 0
+        for index0 in changes:
+            for index1 in self.neighbors[index0]:
+                if index1 < index0 and index1 in changes:
+                    continue
+                delta += (child_chromosome[index0] == child_chromosome[index1]) - \
+                         (chromosome[index0] == chromosome[index1])
+        return delta
+
     def crossover(self, chromosome0, chromosome1):
+        (child_chromosome0, _), (child_chromosome1, _) = self.crossover_changes(chromosome0, chromosome1)
+        return child_chromosome0, child_chromosome1
+
+    def crossover_changes(self, chromosome0, chromosome1):
         index = int(random.uniform(0, 1) * len(self.blocks))
         child_chromosome0 = chromosome0[:index] + chromosome1[index:]
         child_chromosome1 = chromosome1[:index] + chromosome0[index:]
-        return child_chromosome0, child_chromosome1
+        changes = set(i for i in range(index, len(self.blocks)) if chromosome0[i] != chromosome1[i])
+        return (child_chromosome0, changes), (child_chromosome1, set(changes))
 
     def mutate(self, chromosome):
+        chromosome_, _ = self.mutate_changes(chromosome, set())
+        return chromosome_
+
+    def mutate_changes(self, chromosome, changes):
         mutation = int(round(self.mutation_ratio * len(self.blocks)))
         chromosome_ = chromosome
         for _ in range(mutation):
@@ -86,7 +159,8 @@ class ColorMap(object):
             colors.remove(old_color)
             new_color = random.choice(colors)
             chromosome_ = chromosome_[:index] + new_color + chromosome_[index+1:]
-        return chromosome_
+            changes.add(index)
+        return chromosome_, changes
 
     @staticmethod
     def chunker(str, size):
@@ -94,49 +168,385 @@ class ColorMap(object):
 
     def make_map(self, chromosome):
         map_string = ''.join(self.map)
-        d = self.get_block_color_dict(chromosome)
-        for k, v in d.items():
-            map_string = map_string.replace(k, v)
+        map_string = map_string.translate(str.maketrans(self.blocks, chromosome))
         return list(self.chunker(map_string, self.width))
 
     @staticmethod
     def normalize_map(map):
         return '\n'.join(map)
 
-    def solve(self):
-        best_chromosome = self.COLORS[0] * len(self.blocks)
-        best_fitness = 0.0
-        for i in range(self.max_generation):
-            chromosome_fitnesses = []
-            for chromosome in self.chromosomes:
-                fitness = self.fitness(chromosome)
-                chromosome_fitnesses.append((chromosome, fitness))
+    def encode(self, chromosomes):
+        lookup = np.zeros(256, dtype=np.uint8)
+        for index, color in enumerate(self.COLORS):
+            lookup[ord(color)] = index
+        genes = np.frombuffer(''.join(chromosomes).encode('ascii'), dtype=np.uint8)
+        return lookup[genes].reshape(len(chromosomes), len(self.blocks))
+
+    def decode(self, population):
+        colors = np.array([ord(color) for color in self.COLORS], dtype=np.uint8)
+        return [row.tobytes().decode('ascii') for row in colors[population]]
+
+    def fitness_population(self, population):
+        edges0, edges1 = self.edges
+        return (population[:, edges0] != population[:, edges1]).sum(axis=1) / len(self.adjacency)
+
+    def crossover_population(self, parents0, parents1, rng):
+        indexes = (rng.random(len(parents0)) * len(self.blocks)).astype(np.intp)
+        mask = np.arange(len(self.blocks))[np.newaxis, :] < indexes[:, np.newaxis]
+        children0 = np.where(mask, parents0, parents1)
+        children1 = np.where(mask, parents1, parents0)
+        return np.vstack((children0, children1))
+
+    def mutate_population(self, population, rng):
+        mutation = int(round(self.mutation_ratio * len(self.blocks)))
+        rows = np.arange(len(population))[:, np.newaxis]
+        indexes = rng.integers(0, len(self.blocks), size=(len(population), mutation))
+        shifts = rng.integers(1, len(self.COLORS), size=(len(population), mutation), dtype=np.uint8)
+        population[rows, indexes] = (population[rows, indexes] + shifts) % len(self.COLORS)
+        return population
+
+    def solve(self, method='ga', resume_from=None):
+        solvers = {
+            'ga': self.solve_ga,
+            'numpy': self.solve_numpy,
+            'dsatur': self.solve_dsatur,
+            'min_conflicts': self.solve_min_conflicts,
+            'islands': self.solve_islands,
+        }
+        if method not in solvers:
+            raise ValueError('Unknown method: {0}'.format(method))
+        if resume_from is not None:
+            self.set_state(load_checkpoint(resume_from))
+        return solvers[method]()
+
+    def solve_numpy(self):
+        '''
+        Same genetic algorithm as solve_ga,
+        with the whole population kept in a (chromosome_size, len(blocks)) uint8 matrix
+        so that fitness, crossover and mutation run as array operations per generation.
+        The NumPy generator state is checkpointed, so a resumed run continues the interrupted one.
+        '''
+        if self.numpy_rng_state is None:
+            rng = np.random.default_rng(random.getrandbits(64))
+        else:
+            rng = np.random.default_rng()
+            rng.bit_generator.state = self.numpy_rng_state
+        pairs = int(self.chromosome_size / 2)
+        population = self.encode(self.chromosomes)
+        best_genes = self.encode([self.best_chromosome])[0]
+        self.telemetry.start(self.generation, self.evaluations)
+        for i in range(self.generation, self.max_generation):
+            order = rng.permutation(len(population))
+            parents0 = population[order[0:pairs*2:2]]
+            parents1 = population[order[1:pairs*2:2]]
+            children = self.mutate_population(self.crossover_population(parents0, parents1, rng), rng)
+
+            population = np.vstack((population, children))
+            fitnesses = self.fitness_population(population)
+            ranking = np.argsort(-fitnesses, kind='stable')[:self.chromosome_size]
+            population = population[ranking]
+            self.generation = i + 1
+            self.evaluations += len(fitnesses)
+            best_trial_fitness = float(fitnesses[ranking[0]])
+
+            if self.telemetry.sample(i):
+                self.telemetry.record(i, self.decode(population[:1])[0], best_trial_fitness,
+                                      float(fitnesses[ranking].mean()), self.evaluations)
+            if best_trial_fitness > self.best_fitness:
+                best_genes, self.best_fitness = population[0].copy(), best_trial_fitness
+                self.last_updated_generation = i
+
+            if self.checkpoint_path and self.generation % self.checkpoint_every == 0:
+                self.chromosomes = self.decode(population)
+                self.best_chromosome = self.decode(best_genes[np.newaxis, :])[0]
+                self.numpy_rng_state = rng.bit_generator.state
+                self.save_checkpoint(self.checkpoint_path)
+
+            if self.best_fitness >= self.success_threshold:
+                break
+
+            if i - self.last_updated_generation > self.max_no_update_generation:
+                break
+
+        self.chromosomes = self.decode(population)
+        self.best_chromosome = self.decode(best_genes[np.newaxis, :])[0]
+        self.numpy_rng_state = rng.bit_generator.state
+        best_color_map = self.normalize_map(self.make_map(self.best_chromosome))
+
+        return self.best_chromosome, self.best_fitness, best_color_map
+
+    def solve_dsatur(self):
+        '''
+        DSATUR with backtracking on the block adjacency graph.
+        The uncolored block with the most distinct neighbour colors
+        (then the most neighbours) is colored next with the first color
+        not used by its neighbours; on a dead end the last choice is undone.
+        Chronological backtracking can thrash on large maps,
+        so after max_nodes assignments the partial coloring is completed
+        greedily and handed to the min-conflicts search.
+        If the search is exhausted, i.e. the map is not colorable with COLORS,
+        the deepest partial coloring at a dead end is handed over instead.
+        '''
+        size = len(self.blocks)
+        colors = [None] * size
+        neighbor_color_counts = [[0] * len(self.COLORS) for _ in range(size)]
+        saturations = [0] * size
+        heap = [(0, -len(self.neighbors[v]), v) for v in range(size)]
+        heapq.heapify(heap)
+
+        def push(v):
+            heapq.heappush(heap, (-saturations[v], -len(self.neighbors[v]), v))
+
+        def select():
+            while heap:
+                saturation, _, v = heapq.heappop(heap)
+                if colors[v] is None and -saturation == saturations[v]:
+                    return v
+            return None
+
+        def assign(v, color):
+            colors[v] = color
+            for u in self.neighbors[v]:
+                neighbor_color_counts[u][color] += 1
+                if neighbor_color_counts[u][color] == 1:
+                    saturations[u] += 1
+                    if colors[u] is None:
+                        push(u)
+
+        def unassign(v):
+            color, colors[v] = colors[v], None
+            for u in self.neighbors[v]:
+                neighbor_color_counts[u][color] -= 1
+                if neighbor_color_counts[u][color] == 0:
+                    saturations[u] -= 1
+                    if colors[u] is None:
+                        push(u)
+            push(v)
+
+        stack = []
+        deepest_colors, deepest = colors, -1
+        nodes = 0
+        max_nodes = self.max_nodes or 4 * size
+        v = select()
+        while v is not None:
+            if nodes >= max_nodes:
+                return self.solve_min_conflicts(self.complete_coloring(colors))
+            nodes += 1
+            candidates = [c for c in range(len(self.COLORS)) if not neighbor_color_counts[v][c]]
+            if not candidates:
+                if len(stack) > deepest:
+                    deepest_colors, deepest = list(colors), len(stack)
+                push(v)
+            while not candidates and stack:
+                v, candidates = stack.pop()
+                unassign(v)
+            if not candidates:
+                return self.solve_min_conflicts(self.complete_coloring(deepest_colors))
+            assign(v, candidates[0])
+            stack.append((v, candidates[1:]))
+            v = select()
+
+        best_chromosome = ''.join(self.COLORS[c] for c in colors)
+        best_fitness = self.fitness(best_chromosome)
+        best_color_map = self.normalize_map(self.make_map(best_chromosome))
+
+        return best_chromosome, best_fitness, best_color_map
+
+    def complete_coloring(self, colors):
+        '''
+        Color the uncolored blocks of a partial coloring one by one
+        with the color shared by the fewest colored neighbours.
+        '''
+        colors = list(colors)
+        for v in range(len(colors)):
+            if colors[v] is None:
+                counts = [0] * len(self.COLORS)
+                for u in self.neighbors[v]:
+                    if colors[u] is not None:
+                        counts[colors[u]] += 1
+                colors[v] = counts.index(min(counts))
+        return colors
+
+    def solve_min_conflicts(self, colors=None):
+        '''
+        Min-conflicts local search starting from the given colors,
+        by default from the fittest chromosome.
+        A random conflicted block is recolored with the color shared by
+        the fewest neighbours (or, with probability noise_ratio, a random color)
+        until no conflict is left or max_steps is reached.
+        '''
+        if colors is None:
+            chromosome = max(self.chromosomes, key=self.fitness)
+            colors = [self.COLORS.index(c) for c in chromosome]
+        # Conflicted blocks in a list with their positions, so adding, removing
+        # and picking a random one are all O(1).
+        conflicted = [v for v in range(len(self.blocks))
+                      if any(colors[u] == colors[v] for u in self.neighbors[v])]
+        positions = dict((v, i) for i, v in enumerate(conflicted))
+        for _ in range(self.max_steps):
+            if not conflicted:
+                break
+            v = random.choice(conflicted)
+            counts = [0] * len(self.COLORS)
+            for u in self.neighbors[v]:
+                counts[colors[u]] += 1
+            if random.uniform(0, 1) < self.noise_ratio:
+                colors[v] = random.randrange(len(self.COLORS))
+            else:
+                least = min(counts)
+                colors[v] = random.choice([c for c, count in enumerate(counts) if count == least])
+            for u in self.neighbors[v] + [v]:
+                if any(colors[w] == colors[u] for w in self.neighbors[u]):
+                    if u not in positions:
+                        positions[u] = len(conflicted)
+                        conflicted.append(u)
+                elif u in positions:
+                    last = conflicted.pop()
+                    i = positions.pop(u)
+                    if last != u:
+                        conflicted[i], positions[last] = last, i
+
+        best_chromosome = ''.join(self.COLORS[c] for c in colors)
+        best_fitness = self.fitness(best_chromosome)
+        best_color_map = self.normalize_map(self.make_map(best_chromosome))
+
+        return best_chromosome, best_fitness, best_color_map
+
+    def solve_ga(self):
+        self.evolve(self.max_generation - self.generation)
+        best_color_map = self.normalize_map(self.make_map(self.best_chromosome))
+
+        return self.best_chromosome, self.best_fitness, best_color_map
+
+    def evolve(self, generations):
+        '''
+        Run up to the given number of generations from the current state.
+        Return True if the run is finished, i.e. the success threshold,
+        max_generation or max_no_update_generation is reached or stop_event is set.
+        '''
+        edge_count = len(self.adjacency)
+        chromosome_conflicts = [(chromosome, self.conflicts(chromosome)) for chromosome in self.chromosomes]
+        self.evaluations += len(chromosome_conflicts)
+        self.telemetry.start(self.generation, self.evaluations)
+        for i in range(self.generation, min(self.generation + generations, self.max_generation)):
+            if self.stop_event is not None and self.stop_event.is_set():
+                return True
+
+            chromosome_fitnesses = [(chromosome, (edge_count - conflicts) / edge_count, conflicts)
+                                    for chromosome, conflicts in chromosome_conflicts]
             random.shuffle(chromosome_fitnesses)
 
             for j in range(int(self.chromosome_size / 2)):
-                children_chromosomes = self.crossover(chromosome_fitnesses[j*2][0], chromosome_fitnesses[j*2+1][0])
-                for chromosome in children_chromosomes:
-                    chromosome = self.mutate(chromosome)
-                    fitness = self.fitness(chromosome)
-                    chromosome_fitnesses.append((chromosome, fitness))
+                parents = chromosome_fitnesses[j*2], chromosome_fitnesses[j*2+1]
+                children_changes = self.crossover_changes(parents[0][0], parents[1][0])
+                for (parent, _, conflicts), (chromosome, changes) in zip(parents, children_changes):
+                    chromosome, changes = self.mutate_changes(chromosome, changes)
+                    conflicts += self.delta_conflicts(parent, chromosome, changes)
+                    chromosome_fitnesses.append((chromosome, (edge_count - conflicts) / edge_count, conflicts))
+            self.evaluations += len(chromosome_fitnesses) - len(chromosome_conflicts)
             chromosome_fitnesses.sort(key=lambda x: -x[1])
+            chromosome_conflicts = [(chromosome, conflicts) for chromosome, _, conflicts
+                                    in chromosome_fitnesses[:self.chromosome_size]]
             self.chromosomes = list(list(zip(*chromosome_fitnesses))[0])[:self.chromosome_size]
+            self.generation = i + 1
             best_trial_fitness = chromosome_fitnesses[0][1]
 
-            print('Generation {0}: {1} {2}'.format(i, chromosome_fitnesses[0][0], chromosome_fitnesses[0][1]))
-            if best_trial_fitness > best_fitness:
-                best_chromosome, best_fitness = chromosome_fitnesses[0][0], chromosome_fitnesses[0][1]
+            if self.telemetry.sample(i):
+                fitnesses = [fitness for _, fitness, _ in chromosome_fitnesses[:self.chromosome_size]]
+                self.telemetry.record(i, chromosome_fitnesses[0][0], best_trial_fitness,
+                                      sum(fitnesses) / len(fitnesses), self.evaluations)
+            if best_trial_fitness > self.best_fitness:
+                self.best_chromosome, self.best_fitness = chromosome_fitnesses[0][0], chromosome_fitnesses[0][1]
                 self.last_updated_generation = i
 
-            if best_fitness >= 1.0:
-                break
+            if self.checkpoint_path and self.generation % self.checkpoint_every == 0:
+                self.save_checkpoint(self.checkpoint_path)
 
-            if i - self.last_updated_generation > self.max_no_update_generation:
-                break
-
-        best_color_map = self.normalize_map(self.make_map(best_chromosome))
+            if self.best_fitness >= self.success_threshold:
+                return True
 
-        return best_chromosome, best_fitness, best_color_map
+            if i - self.last_updated_generation > self.max_no_update_generation:
+                return True
+
+        return self.generation >= self.max_generation
+
+    def get_state(self):
+        return {
+            'chromosomes': self.chromosomes,
+            'best_chromosome': self.best_chromosome,
+            'best_fitness': self.best_fitness,
+            'generation': self.generation,
+            'last_updated_generation': self.last_updated_generation,
+            'evaluations': self.evaluations,
+            'numpy_rng_state': self.numpy_rng_state,
+        }
+
+    def set_state(self, state):
+        self.chromosomes = state['chromosomes']
+        self.best_chromosome = state['best_chromosome']
+        self.best_fitness = state['best_fitness']
+        self.generation = state['generation']
+        self.last_updated_generation = state['last_updated_generation']
+        self.evaluations = state['evaluations']
+        self.numpy_rng_state = state.get('numpy_rng_state')
+        self.island_states = state.get('island_states')
+        self.island_finished = state.get('island_finished')
+
+    def save_checkpoint(self, path):
+        save_checkpoint(path, self.get_state())
+
+    def solve_islands(self):
+        '''
+        Island model: run the GA on several independent populations in a process pool.
+        Every migration_interval generations the best migration_size chromosomes
+        of each island replace the worst ones of the next island (ring topology).
+        All islands stop as soon as any of them reaches success_threshold.
+        Telemetry records of the islands, tagged with the island index,
+        are replayed into telemetry as each round of generations returns.
+        Every checkpoint_every generations the states of all islands are checkpointed
+        after migration, and a resumed run restores all of them.
+        '''
+        if self.island_states is not None:
+            states, finished = self.island_states, self.island_finished
+            self.island_states = self.island_finished = None
+        else:
+            states = [dict(self.get_state(), chromosomes=self.chromosomes if k == 0 else self.init_chromosomes())
+                      for k in range(self.islands)]
+            finished = [False] * self.islands
+        last_generation = max(state['generation'] for state in states)
+
+        stop_event = multiprocessing.Event()
+        with multiprocessing.Pool(self.processes or self.islands,
+                                  initializer=_init_island, initargs=(self, stop_event)) as pool:
+            while not all(finished):
+                running = [k for k in range(len(states)) if not finished[k]]
+                tasks = [(k, states[k], self.migration_interval, random.getrandbits(32)) for k in running]
+                for k, (state, done, records) in zip(running, pool.map(_evolve_island, tasks)):
+                    states[k], finished[k] = state, done
+                    for record in records:
+                        self.telemetry.replay(record)
+                if stop_event.is_set():
+                    break
+
+                for k, l in zip(running, running[1:] + running[:1]):
+                    if k != l:
+                        migrants = states[k]['chromosomes'][:self.migration_size]
+                        chromosomes = states[l]['chromosomes']
+                        states[l]['chromosomes'] = chromosomes[:len(chromosomes) - len(migrants)] + migrants
+
+                generation = max(state['generation'] for state in states)
+                if self.checkpoint_path and \
+                        generation // self.checkpoint_every > last_generation // self.checkpoint_every:
+                    best_state = max(states, key=lambda state: state['best_fitness'])
+                    save_checkpoint(self.checkpoint_path,
+                                    dict(best_state, island_states=states, island_finished=finished))
+                last_generation = generation
+
+        best_state = max(states, key=lambda state: state['best_fitness'])
+        self.set_state(best_state)
+        best_color_map = self.normalize_map(self.make_map(self.best_chromosome))
+
+        return self.best_chromosome, self.best_fitness, best_color_map
 
     @staticmethod
     def save(normalized_map, path):
@@ -152,13 +562,175 @@ class ColorMap(object):
             extended_map.extend([line] * multiplier)
         return extended_map
 
+
+class ArrayColorMap(ColorMap):
+    '''
+    ColorMap backed by a 2D uint8 array of the map file, memory-mapped when possible.
+    Blocks and adjacent block pairs are extracted by comparing shifted arrays
+    a chunk of rows at a time, so loading takes time linear in the file size
+    and little memory besides the map itself.
+    '''
+
+    CHUNK_ROWS = 4096
+
+    @staticmethod
+    def load_map(map_path):
+        try:
+            data = np.memmap(map_path, dtype=np.uint8, mode='r')
+        except (ValueError, OSError):
+            data = np.fromfile(map_path, dtype=np.uint8)
+        size = len(data)
+        while size and data[size-1] in b'\r\n':
+            size -= 1
+        if not size:
+            raise ValueError('Empty map: {0}'.format(map_path))
+
+        newlines = np.flatnonzero(data[:min(size, 1 << 20)] == ord('\n'))
+        if len(newlines):
+            width = int(newlines[0])
+            stride = width + 1
+        else:
+            width = stride = size
+        if width and data[width-1] == ord('\r'):
+            width -= 1
+        height = (size + stride - width) // stride
+        if (height - 1) * stride + width != size or not ArrayColorMap.has_row_ends(data[:size], width, stride):
+            raise ValueError('Map rows are not of equal width: {0}'.format(map_path))
+        return np.lib.stride_tricks.as_strided(data, shape=(height, width), strides=(stride, 1),
+                                               writeable=False)
+
+    @staticmethod
+    def has_row_ends(data, width, stride):
+        '''
+        Whether every row of the given width ends with a line break of stride - width bytes
+        and no other newline occurs, checked a chunk at a time.
+        '''
+        for offset in range(width, stride):
+            if not (data[offset::stride] == ord('\r' if offset < stride - 1 else '\n')).all():
+                return False
+        chunk_size = ArrayColorMap.CHUNK_ROWS * stride
+        newlines = sum(int(np.count_nonzero(data[i:i + chunk_size] == ord('\n')))
+                       for i in range(0, len(data), chunk_size))
+        return newlines == (len(data) - width) // stride
+
+    def chunks(self):
+        for y in range(0, self.height, self.CHUNK_ROWS):
+            yield self.map[y:y + self.CHUNK_ROWS + 1]
+
+    def get_labels(self):
+        # Distinct labels of each chunk, merged, so memory follows the number of regions.
+        return np.unique(np.concatenate([np.unique(np.asarray(chunk)) for chunk in self.chunks()]))
+
+    def get_adjacent_labels(self):
+        # Pairs are coded by label rank, which stays in range however sparse the labels are.
+        labels = self.get_labels()
+        base = np.int64(len(labels))
+        codes = []
+        for chunk in self.chunks():
+            chunk = np.asarray(chunk)
+            for label0, label1 in ((chunk[:, :-1], chunk[:, 1:]), (chunk[:-1], chunk[1:])):
+                mask = label0 != label1
+                rank0 = np.searchsorted(labels, label0[mask]).astype(np.int64)
+                rank1 = np.searchsorted(labels, label1[mask]).astype(np.int64)
+                codes.append(np.unique(np.minimum(rank0, rank1) * base + np.maximum(rank0, rank1)))
+        codes = np.unique(np.concatenate(codes)) if codes else np.zeros(0, dtype=np.int64)
+        return np.column_stack((labels[codes // base], labels[codes % base]))
+
+    def get_blocks(self):
+        return ''.join(chr(label) for label in self.get_labels())
+
+    def get_adjacency(self):
+        return [(chr(label0), chr(label1)) for label0, label1 in self.get_adjacent_labels()]
+
+    def make_map(self, chromosome):
+        lookup = np.zeros(256, dtype=np.uint8)
+        for block, color in self.get_block_color_dict(chromosome).items():
+            lookup[ord(block)] = ord(color)
+        return [row.tobytes().decode('ascii') for row in lookup[self.map]]
+
+    def extend_map(self, multiplier):
+        extended_map = np.repeat(np.repeat(self.map, multiplier, axis=0), multiplier, axis=1)
+        return [row.tobytes().decode('ascii') for row in extended_map]
+
+
+class LabelColorMap(ArrayColorMap):
+    '''
+    ColorMap of a map stored as a 2D array of non-negative integer region labels (.npy),
+    so that the number of regions is not limited by the printable characters.
+    Blocks are the sorted label array, adjacency is a list of label pairs,
+    and a chromosome is one byte per block as usual.
+    Fitness and rendering go through label lookup tables instead of dicts.
+    The map has no text rows to extend, so extend_labels returns
+    the extended label array, to be saved with np.save, instead of extend_map.
+    '''
+
+    @staticmethod
+    def load_map(map_path):
+        labels = np.load(map_path, mmap_mode='r')
+        if labels.ndim != 2 or labels.dtype.kind not in 'iu':
+            raise ValueError('Map must be a 2D integer label array: {0}'.format(map_path))
+        return labels
+
+    def get_blocks(self):
+        return self.get_labels()
+
+    def get_adjacency(self):
+        return [(int(label0), int(label1)) for label0, label1 in self.get_adjacent_labels()]
+
+    def random_chromosome(self):
+        return ''.join(random.choices(self.COLORS, k=len(self.blocks)))
+
+    def get_edges(self):
+        pairs = np.array(self.adjacency, dtype=np.int64).reshape(-1, 2)
+        return np.searchsorted(self.blocks, pairs[:, 0]), np.searchsorted(self.blocks, pairs[:, 1])
+
+    def compute_fitness(self, chromosome):
+        return float(self.fitness_population(self.encode([chromosome]))[0])
+
+    def conflicts(self, chromosome):
+        edges0, edges1 = self.edges
+        genes = self.encode([chromosome])[0]
+        return int((genes[edges0] == genes[edges1]).sum())
+
+    def make_map(self, chromosome):
+        colors = np.frombuffer(chromosome.encode('ascii'), dtype=np.uint8)
+        return [colors[np.searchsorted(self.blocks, row)].tobytes().decode('ascii') for row in self.map]
+
+    def extend_map(self, multiplier):
+        raise TypeError('Label maps have no text rows, use extend_labels')
+
+    def extend_labels(self, multiplier):
+        return np.repeat(np.repeat(self.map, multiplier, axis=0), multiplier, axis=1)
+
+_island_color_map = None
+
+
+def _init_island(color_map, stop_event):
+    global _island_color_map
+    _island_color_map = color_map
+    _island_color_map.stop_event = stop_event
+    _island_color_map.checkpoint_path = None
+
+
+def _evolve_island(task):
+    island, state, generations, seed = task
+    random.seed(seed)
+    color_map = _island_color_map
+    color_map.telemetry = color_map.telemetry.detach()
+    color_map.set_state(state)
+    done = color_map.evolve(generations)
+    if color_map.best_fitness >= color_map.success_threshold:
+        color_map.stop_event.set()
+    return color_map.get_state(), done, [dict(record, island=island) for record in color_map.telemetry.records]
+
+
 if __name__ == '__main__':
     import time
 
     start = time.time()
 
     map_path = 'q1/map.txt'
-    color_map = ColorMap(map_path)
+    color_map = ColorMap(map_path, telemetry=GenerationTelemetry(callback=GenerationTelemetry.print_record))
     # print('Testing functions...')
     # print(color_map.height)
     # print(color_map.width)
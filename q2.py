@@ -2,9 +2,10 @@
 
 from __future__ import print_function, division
 import re
-import math
+import heapq
 import operator
-from copy import deepcopy
+import weakref
+import numpy as np
 
 __author__ = 'Ben Lai'
 __email__ = "laichunpongben@gmail.com"
@@ -13,369 +14,794 @@ __email__ = "laichunpongben@gmail.com"
 class Algebra(object):
     '''
     Parse algebraic expression into polynomials and evaluate it.
+    The power operator ^ takes a non-negative integer exponent,
+    binds tighter than * and is right-associative.
+    Within a literal it applies to the last factor only, e.g. 2ab^2 is 2*a*b^2.
+    Parenthesized groups are hash-consed by their tokens,
+    so a group repeated in the expression is parsed and reduced once.
+    Pass the same subexpressions dict to several instances to share groups across them.
+    Evaluations are specialized once per set of bound variable names,
+    so later assignments binding the same names only substitute values.
     '''
 
-    def __init__(self, expression):
+    TOKENS = re.compile(r"\s*(?:([0-9a-z]+)|(\S))")
+    BINDING_POWERS = {'+': 10, '-': 10, '*': 20, '^': 30}
+
+    def __init__(self, expression, **kwargs):
         self.expression = expression
-        self.children = []
+        self.tokens = self.tokenize(self.expression)
+        self.subexpressions = kwargs.get('subexpressions', {})
+        self.closing, self.groups = self.index_groups(self.tokens, self.subexpressions)
+        self.index = 0
         self.polynomial = None
-        self.parse(self.expression)
-        self.regex_children = self.get_regex_children()
+        self.vectorized_polynomial = None
+        self.specialized_polynomials = {}
         self.calc()
 
     def __str__(self):
         return self.expression
 
-    def parse(self, expression):
-        if not '(' in expression or not ')' in expression:
-            return
+    @staticmethod
+    def tokenize(expression):
+        return [literal or operator_ for literal, operator_ in Algebra.TOKENS.findall(expression)]
 
-        counter = 0
-        index_start, index_end = 0, 0
-        for index, c in enumerate(expression):
-            if c == '(':
-                counter += 1
-                if counter == 1:
-                    index_start = index+1
-            elif c == ')':
-                counter += -1
-                if counter == 0:
-                    index_end = index
-                    algebra = Algebra(expression[index_start:index_end])
-                    self.children.append(algebra)
-            if counter < 0:
-                return
-        return
-
-    def get_regex_children(self):
-        regex = r"("
-        for index, child in enumerate(self.children):
-            if index > 0:
-                regex += r"|"
-            regex += r"\(" + re.escape(child.expression) + r"\)"
-        regex += r")"
-        return re.compile(regex)
+    @staticmethod
+    def index_groups(tokens, subexpressions):
+        '''
+        Match the parentheses and hash-cons the groups bottom-up.
+        The key of a group is its tokens with each inner group replaced
+        by the id of the inner group's cache entry, so every token is hashed once.
+        Return the closing index and the cache entry, a [polynomial] list, of each group by opening index.
+        '''
+        closing = {}
+        groups = {}
+        openings = []
+        keys = [[]]
+        for index, token in enumerate(tokens):
+            if token == '(':
+                openings.append(index)
+                keys.append([])
+            elif token == ')' and openings:
+                opening = openings.pop()
+                closing[opening] = index
+                groups[opening] = subexpressions.setdefault(tuple(keys.pop()), [None])
+                keys[-1].append(id(groups[opening]))
+            else:
+                keys[-1].append(token)
+        return closing, groups
 
     def calc(self):
-        while not self.polynomial:
-            if self.children:
-                if all(child.polynomial for child in self.children):
-                    expressions = re.split(self.regex_children, self.expression)
-                    for child in self.children:
-                        for index, expression in enumerate(expressions):
-                            if expression == '(' + child.expression + ')':
-                                expressions = expressions[:index] + [child.polynomial] + expressions[index+1:]
-
-                    polynomials = []
-                    for expression in expressions:
-                        if not isinstance(expression, Polynomial):
-                            elements = re.split(r"([\+\-\*])", expression)
-                            polynomials.extend(elements)
-                        else:
-                            polynomials.append(expression)
-                    polynomials = [p for p in polynomials if p or p == '0']
-                    polynomials = [Polynomial(p) if not isinstance(p, Polynomial) and
-                                   p not in ['+', '-', '*'] else p for p in polynomials]
-
-                    index = 0
-                    while '*' in polynomials:
-                        if index == len(polynomials) - 1:
-                            break
-
-                        if polynomials[index] == '*':
-                            polynomial = polynomials[index-1].multiply(polynomials[index+1])
-                            polynomials = polynomials[:index-1] + [polynomial] + polynomials[index+2:]
-                            index += -1
-                        index += 1
-
-                    index = 0
-                    while len(polynomials) > 1:
-                        if index == len(polynomials) - 1:
-                            break
-
-                        if polynomials[index] == '+':
-                            if index == 0:
-                                polynomials = polynomials[index+1:]
-                            else:
-                                polynomial = polynomials[index-1].add(polynomials[index+1])
-                                polynomials = polynomials[:index-1] + [polynomial] + polynomials[index+2:]
-                            index += -1
-                        elif polynomials[index] == '-':
-                            if index == 0:
-                                polynomial = polynomials[index+1].multiply(Polynomial('-1'))
-                                polynomials = [polynomial] + polynomials[index+2:]
-                            else:
-                                polynomial = polynomials[index-1].subtract(polynomials[index+1])
-                                polynomials = polynomials[:index-1] + [polynomial] + polynomials[index+2:]
-                            index += -1
-                        index += 1
-
-                    self.polynomial = polynomials[0]
-                else:
-                    for child in self.children:
-                        if not child.polynomial:
-                            child.calc()
+        self.index = 0
+        self.polynomial = self.parse(0)
+        if self.index < len(self.tokens):
+            raise ValueError('Unexpected {0!r} in expression: {1}'.format(self.tokens[self.index], self.expression))
+
+    def parse(self, binding_power):
+        '''
+        Operator-precedence (Pratt) parser over the token list,
+        building the polynomial of the operators binding tighter than binding_power.
+        '''
+        polynomial = self.parse_prefix()
+        while self.index < len(self.tokens):
+            operator_ = self.tokens[self.index]
+            if operator_ == ')':
+                break
+            if operator_ not in self.BINDING_POWERS:
+                raise ValueError('Unexpected {0!r} in expression: {1}'.format(operator_, self.expression))
+            if self.BINDING_POWERS[operator_] <= binding_power:
+                break
+            self.index += 1
+            if operator_ == '*':
+                factors = [polynomial, self.parse(self.BINDING_POWERS['*'])]
+                while self.index < len(self.tokens) and self.tokens[self.index] == '*':
+                    self.index += 1
+                    factors.append(self.parse(self.BINDING_POWERS['*']))
+                polynomial = Polynomial.product(factors)
+            elif operator_ == '^':
+                polynomial = polynomial.power(self.parse_exponent())
             else:
-                self.polynomial = Polynomial(self.expression)
+                polynomial = self.apply(operator_, polynomial, self.parse(self.BINDING_POWERS[operator_]))
+        return polynomial
+
+    def parse_prefix(self):
+        if self.index == len(self.tokens):
+            raise ValueError('Unexpected end of expression: {0}'.format(self.expression))
+        token = self.tokens[self.index]
+        self.index += 1
+        if token == '(':
+            group = self.groups.get(self.index - 1)
+            if group is not None and group[0] is not None:
+                self.index = self.closing[self.index - 1] + 1
+                return group[0]
+            polynomial = self.parse(0)
+            if self.index == len(self.tokens) or self.tokens[self.index] != ')':
+                raise ValueError('Missing ) in expression: {0}'.format(self.expression))
+            self.index += 1
+            if group is not None:
+                group[0] = polynomial
+            return polynomial
+        elif token == '-':
+            return self.parse(self.BINDING_POWERS['-']).multiply(Polynomial('-1'))
+        elif token == '+':
+            return self.parse(self.BINDING_POWERS['+'])
+        elif token[0].isalnum():
+            if self.index < len(self.tokens) and self.tokens[self.index] == '^':
+                self.index += 1
+                return Polynomial(None, terms=[Term.power_literal(token, self.parse_exponent())])
+            return Polynomial(token)
+        else:
+            raise ValueError('Unexpected {0!r} in expression: {1}'.format(token, self.expression))
+
+    def parse_exponent(self):
+        polynomial = self.parse(self.BINDING_POWERS['^'] - 1)
+        exponent = polynomial.coefficients.get(Monomial(()), 0)
+        if len(polynomial.coefficients) > (1 if exponent else 0) or exponent < 0:
+            raise ValueError('Exponent must be a non-negative integer in expression: {0}'.format(self.expression))
+        return exponent
+
+    @staticmethod
+    def apply(operator_, polynomial0, polynomial1):
+        if operator_ == '+':
+            return polynomial0.add(polynomial1)
+        elif operator_ == '-':
+            return polynomial0.subtract(polynomial1)
+        else:
+            return polynomial0.multiply(polynomial1)
 
     @staticmethod
     def string_to_dict(param_str):
         return dict((k, int(v)) for k, v in (item.split('=') for item in param_str.split(',')))
 
     def eval(self, params):
-        return self.polynomial.eval(params)
+        return self.specialize(params).eval(params)
+
+    def specialize(self, params):
+        bound = frozenset(params)
+        try:
+            return self.specialized_polynomials[bound]
+        except KeyError:
+            specialized_polynomial = self.polynomial.specialize(bound)
+            self.specialized_polynomials[bound] = specialized_polynomial
+            return specialized_polynomial
 
     def eval_str(self, param_str):
         params = self.string_to_dict(param_str)
         return self.eval(params)
 
+    def vectorize(self):
+        if self.vectorized_polynomial is None:
+            self.vectorized_polynomial = self.polynomial.vectorize()
+        return self.vectorized_polynomial
+
+    def eval_lines(self, param_strs):
+        return self.vectorize().eval_params([self.string_to_dict(param_str) for param_str in param_strs])
+
+    def eval_matrix(self, variables, values):
+        return self.vectorize().polynomials(variables, values)
+
 class Polynomial(object):
-    OPERATORS = re.compile(r"(\+|\-|\*)")
+    '''
+    Sparse polynomial as a dict from interned Monomial to non-zero integer coefficient,
+    the constant being the coefficient of the empty monomial.
+    Addition, subtraction and multiplication are dict merges,
+    so results are always fully reduced.
+    '''
+
+    OPERATORS = re.compile(r"(\+|\-|\*|\^)")
+    KRONECKER_THRESHOLD = 4096
+    DENSE_RATIO = 64
+    DENSE_LIMIT = 2 ** 24
+
+    __slots__ = ('coefficients', '_expression')
 
     def __init__(self, expression=None, **kwargs):
-        self.terms = []
         if expression:
-            self.terms = self.parse(expression)
+            self.coefficients = self.merge(self.parse(expression))
+        elif 'coefficients' in kwargs:
+            self.coefficients = kwargs['coefficients']
         else:
-            self.terms = kwargs.get('terms', [])
-        self.expression = self.__str__()
+            self.coefficients = self.merge(kwargs.get('terms', []))
+        self._expression = None
 
     def __str__(self):
-        expression = ''
-        for index, term in enumerate(self.terms):
-            if index > 0:
-                if term.coefficient > 0:
-                    expression += '+'
-                    expression += term.expression
-                elif term.coefficient < 0:
-                    expression += term.expression
-                else:
-                    if term.constant > 0:
-                        expression += '+'
-                        expression += term.expression
-                    elif term.constant < 0:
-                        expression += term.expression
-                    else:
-                        pass
-            else:
-                expression += term.expression
-        return expression
+        return self.expression
+
+    @property
+    def expression(self):
+        '''
+        Rendered on first use and cached, as most intermediate polynomials are never printed.
+        '''
+        if self._expression is None:
+            self._expression = self.render()
+        return self._expression
+
+    def render(self):
+        '''
+        Render the terms in order into a single buffer of string parts.
+        '''
+        items = sorted(self.coefficients.items(), key=self.item_sort_key, reverse=True)
+        if not items:
+            return '0'
+        parts = []
+        for monomial, coefficient in items:
+            if parts and coefficient > 0:
+                parts.append('+')
+            Term.render_parts(parts, coefficient, monomial.powers)
+        return ''.join(parts)
+
+    @staticmethod
+    def item_sort_key(item):
+        monomial, coefficient = item
+        if monomial.powers:
+            return 1, monomial.key, coefficient
+        return 0, 0, coefficient
 
     def __eq__(self, polynomial):
         if self is polynomial:
             return True
         elif not isinstance(polynomial, self.__class__):
             return False
-        elif self.terms == polynomial.terms:
-            return True
         else:
-            return False
+            return self.coefficients == polynomial.coefficients
 
     def __hash__(self):
-        result = 17
-        for term in sorted(self.terms):
-            result = result * 31 + term.__hash__()
-        return result
+        return hash(frozenset(self.coefficients.items()))
 
-    @staticmethod
-    def parse(expression):
-        term_expressions = []
-        elements = re.split(Polynomial.OPERATORS, expression)
-        elements_ = [x for x in elements if x]
+    def __getstate__(self):
+        return self.coefficients
 
-        index = 0
-        while True:
-            if index == len(elements_) - 1:
-                break
-            if not any(x in elements_ for x in ['*', '+', '-']):
-                break
+    def __setstate__(self, coefficients):
+        self.coefficients = coefficients
+        self._expression = None
+
+    @property
+    def terms(self):
+        terms = sorted([Term.from_monomial(monomial, coefficient)
+                        for monomial, coefficient in self.coefficients.items()],
+                       key=operator.attrgetter('sort_key'), reverse=True)
+        return terms or [Term(None, coefficient=0, variables={}, constant=0)]
 
-            if elements_[index] == '*':
-                term = Term(elements_[index-1]).multiply(Term(elements_[index+1]))
-                elements_ = elements_[:index-1] + [term.expression] + elements_[index+2:]
-                index = 0
-            elif elements_[index] == '-':
-                term = Term(elements_[index+1]).multiply(Term('-1'))
-                elements_ = elements_[:index] + [term.expression] + elements_[index+2:]
-                index = 0
-            elif elements_[index] == '+':
-                elements_ = elements_[:index] + elements_[index+1:]
-                index = 0
+    @staticmethod
+    def merge(terms):
+        coefficients = {}
+        for term in terms:
+            coefficient = term.coefficient if term.monomial.powers else term.constant
+            coefficient += coefficients.get(term.monomial, 0)
+            if coefficient:
+                coefficients[term.monomial] = coefficient
             else:
-                index += 1
+                coefficients.pop(term.monomial, None)
+        return coefficients
 
-        for x in elements_:
-            if x:
-                if x.startswith('+'):
-                    term_expressions.append(x[1:])
+    @staticmethod
+    def parse(expression):
+        terms = []
+        term = None
+        sign = 1
+        multiply = False
+        elements = [element for element in re.split(Polynomial.OPERATORS, expression) if element]
+        index = 0
+        while index < len(elements):
+            element = elements[index]
+            index += 1
+            if element == '*':
+                multiply = True
+            elif element == '^':
+                raise ValueError('Unexpected ^ in expression: {0}'.format(expression))
+            elif element in '+-':
+                if term is not None:
+                    terms.append(term if sign > 0 else term.multiply(Term('-1')))
+                    term = None
+                    sign = 1
+                if element == '-':
+                    sign = -sign
+            else:
+                exponents = []
+                while elements[index:index+1] == ['^'] and index + 1 < len(elements):
+                    exponents.append(int(elements[index+1]))
+                    index += 2
+                if exponents:
+                    exponent = exponents.pop()
+                    while exponents:
+                        exponent = exponents.pop() ** exponent
+                    factor = Term.power_literal(element, exponent)
                 else:
-                    term_expressions.append(x)
-
-        terms = [Term(expression) for expression in term_expressions]
+                    factor = Term(element)
+                if multiply and term is not None:
+                    term = term.multiply(factor)
+                else:
+                    term = factor
+                multiply = False
+        if term is not None:
+            terms.append(term if sign > 0 else term.multiply(Term('-1')))
         return terms
 
     def add(self, polynomial):
-        terms = sorted(self.terms[:] + polynomial.terms[:], reverse=True)
-        terms = self.reduce(terms)
-        return Polynomial(None, terms=terms)
+        coefficients = dict(self.coefficients)
+        for monomial, coefficient in polynomial.coefficients.items():
+            coefficient += coefficients.get(monomial, 0)
+            if coefficient:
+                coefficients[monomial] = coefficient
+            else:
+                del coefficients[monomial]
+        return Polynomial(None, coefficients=coefficients)
 
     def subtract(self, polynomial):
-        new_terms = []
-        for term in polynomial.terms:
-            if term.coefficient == 0:
-                term_ = Term(None, coefficient=0, variables={}, constant=-term.constant)
+        coefficients = dict(self.coefficients)
+        for monomial, coefficient in polynomial.coefficients.items():
+            coefficient = coefficients.get(monomial, 0) - coefficient
+            if coefficient:
+                coefficients[monomial] = coefficient
             else:
-                term_ = Term(None, coefficient=-term.coefficient, variables=term.variables, constant=term.constant)
-            new_terms.append(term_)
-
-        terms = sorted(self.terms + new_terms, reverse=True)
-        terms = self.reduce(terms)
-        return Polynomial(None, terms=terms)
+                del coefficients[monomial]
+        return Polynomial(None, coefficients=coefficients)
 
     def multiply(self, polynomial):
-        terms = []
-        for term0 in self.terms:
-            for term1 in polynomial.terms:
-                term = term0.multiply(term1)
-                terms.append(term)
-        terms = self.reduce(terms)
-        return Polynomial(None, terms=terms)
+        if len(self.coefficients) * len(polynomial.coefficients) >= self.KRONECKER_THRESHOLD:
+            return self.multiply_kronecker(polynomial)
+        coefficients = {}
+        for monomial0, coefficient0 in self.coefficients.items():
+            for monomial1, coefficient1 in polynomial.coefficients.items():
+                monomial = monomial0.multiply(monomial1)
+                coefficients[monomial] = coefficients.get(monomial, 0) + coefficient0 * coefficient1
+        return Polynomial(None, coefficients=dict((k, v) for k, v in coefficients.items() if v))
+
+    def multiply_kronecker(self, polynomial):
+        '''
+        Kronecker substitution: each monomial becomes an integer code in a mixed radix
+        large enough that codes add without carry when monomials multiply.
+        When the codes are dense enough, both operands are packed into big integers
+        with one 64-bit field per code and multiplied with a single (Karatsuba) integer product,
+        otherwise the products are accumulated in a dict keyed by code.
+        '''
+        variables = sorted(set(k for monomial in self.coefficients for k, _ in monomial.powers) |
+                           set(k for monomial in polynomial.coefficients for k, _ in monomial.powers))
+        radixes = []
+        radix = 1
+        for k in variables:
+            radixes.append(radix)
+            radix *= self.degree(k) + polynomial.degree(k) + 1
+        codes0 = self.encode(variables, radixes)
+        codes1 = polynomial.encode(variables, radixes)
+
+        max_coefficient = max(abs(c) for c in self.coefficients.values()) * \
+            max(abs(c) for c in polynomial.coefficients.values()) * min(len(codes0), len(codes1))
+        size = max(codes0) + max(codes1) + 1
+        if max_coefficient < 2 ** 63 and size <= min(self.DENSE_LIMIT, self.DENSE_RATIO * len(codes0) * len(codes1)):
+            products = self.multiply_packed(codes0, codes1, size)
+        elif max_coefficient < 2 ** 63 and size < 2 ** 63:
+            products = self.multiply_sorted(codes0, codes1)
+        else:
+            products = {}
+            for code0, coefficient0 in codes0.items():
+                for code1, coefficient1 in codes1.items():
+                    code = code0 + code1
+                    products[code] = products.get(code, 0) + coefficient0 * coefficient1
+
+        coefficients = {}
+        for code, coefficient in products.items():
+            if coefficient:
+                powers = []
+                for k, radix in zip(reversed(variables), reversed(radixes)):
+                    v, code = divmod(code, radix)
+                    if v:
+                        powers.append((k, v))
+                coefficients[Monomial(tuple(reversed(powers)))] = coefficient
+        return Polynomial(None, coefficients=coefficients)
 
     @staticmethod
-    def reduce(terms):
-        terms_ = terms[:]
-        index = 0
-        while True:
-            if index == len(terms_) - 1:
-                break
-            if terms_[index].variables == terms_[index+1].variables:
-                term = terms_[index].add(terms_[index+1])
-                terms_ = terms_[:index] + [term] + terms_[index+2:]
-                index += -1
+    def multiply_packed(codes0, codes1, size):
+        def pack(codes):
+            fields = np.zeros(max(codes) + 1, dtype='<i8')
+            fields[list(codes.keys())] = list(codes.values())
+            return int.from_bytes(fields.tobytes(), 'little', signed=False) - \
+                int.from_bytes((fields < 0).astype('<u8').tobytes(), 'little') * 2 ** 64
+
+        # Every field of the product lies in (-2 ** 63, 2 ** 63), adding 2 ** 63 to each makes it unsigned.
+        offset = int.from_bytes(np.full(size, 2 ** 63, dtype='<u8').tobytes(), 'little')
+        product = pack(codes0) * pack(codes1) + offset
+        fields = np.frombuffer(product.to_bytes(size * 8, 'little'), dtype='<u8') ^ np.uint64(2 ** 63)
+        fields = fields.view('<i8')
+        codes = np.flatnonzero(fields)
+        return dict(zip(codes.tolist(), fields[codes].tolist()))
+
+    @staticmethod
+    def multiply_sorted(codes0, codes1):
+        def aggregate(codes, coefficients):
+            order = np.argsort(codes, kind='stable')
+            codes, coefficients = codes[order], coefficients[order]
+            starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))
+            return codes[starts], np.add.reduceat(coefficients, starts)
+
+        codes0, coefficients0 = np.array(list(codes0.keys()), dtype=np.int64), np.array(list(codes0.values()), dtype=np.int64)
+        codes1, coefficients1 = np.array(list(codes1.keys()), dtype=np.int64), np.array(list(codes1.values()), dtype=np.int64)
+        rows = max(1, (1 << 22) // len(codes1))
+        chunks = [aggregate(np.add.outer(codes0[i:i+rows], codes1).ravel(),
+                            np.multiply.outer(coefficients0[i:i+rows], coefficients1).ravel())
+                  for i in range(0, len(codes0), rows)]
+        codes, coefficients = aggregate(np.concatenate([chunk[0] for chunk in chunks]),
+                                        np.concatenate([chunk[1] for chunk in chunks]))
+        return dict(zip(codes.tolist(), coefficients.tolist()))
+
+    def degree(self, variable):
+        return max([v for monomial in self.coefficients for k, v in monomial.powers if k == variable] or [0])
+
+    def encode(self, variables, radixes):
+        radix_dict = dict(zip(variables, radixes))
+        return dict((sum(v * radix_dict[k] for k, v in monomial.powers), coefficient)
+                    for monomial, coefficient in self.coefficients.items())
+
+    def power(self, exponent):
+        '''
+        Raise to a non-negative integer power by repeated squaring,
+        which takes O(log exponent) multiplications.
+        '''
+        result = Polynomial('1')
+        base = self
+        while exponent:
+            if exponent & 1:
+                result = result.multiply(base)
+            exponent >>= 1
+            if exponent:
+                base = base.multiply(base)
+        return result
+
+    @staticmethod
+    def product(polynomials):
+        '''
+        Multiply the polynomials two smallest first (a Huffman-like product tree),
+        so that the large operands meet in a few balanced products.
+        '''
+        heap = [(len(polynomial.coefficients), index, polynomial) for index, polynomial in enumerate(polynomials)]
+        heapq.heapify(heap)
+        index = len(heap)
+        while len(heap) > 1:
+            _, _, polynomial0 = heapq.heappop(heap)
+            _, _, polynomial1 = heapq.heappop(heap)
+            polynomial = polynomial0.multiply(polynomial1)
+            heapq.heappush(heap, (len(polynomial.coefficients), index, polynomial))
             index += 1
+        return heap[0][2]
+
+    @staticmethod
+    def reduce(terms):
+        return Polynomial(None, terms=terms).terms
+
+    def eval(self, params):
+        coefficients = {}
+        for monomial, coefficient in self.coefficients.items():
+            powers = []
+            for k, v in monomial.powers:
+                if k in params:
+                    coefficient *= params[k] ** v
+                else:
+                    powers.append((k, v))
+            monomial = Monomial(tuple(powers))
+            coefficients[monomial] = coefficients.get(monomial, 0) + coefficient
+        return Polynomial(None, coefficients=dict((k, v) for k, v in coefficients.items() if v))
+
+    def vectorize(self):
+        return VectorizedPolynomial(self)
+
+    def specialize(self, bound):
+        return SpecializedPolynomial(self, bound)
+
+    def compile(self):
+        '''
+        Generate a Python function evaluating the polynomial in multivariate Horner form
+        for a full assignment, e.g. f({'a': 1, 'b': 2}) returns an int.
+        '''
+        return self.build_function([dict((monomial.powers, coefficient)
+                                         for monomial, coefficient in self.coefficients.items())])
+
+    @staticmethod
+    def build_function(coefficients_list, returns_tuple=False):
+        lines = []
+        results = [Polynomial.horner(coefficients, lines) for coefficients in coefficients_list]
+        variables = sorted(set(k for coefficients in coefficients_list for powers in coefficients for k, _ in powers))
+        source = ['def evaluate(params):']
+        source += ['    {0} = params[{0!r}]'.format(k) for k in variables]
+        source += ['    {0}'.format(line) for line in lines]
+        if returns_tuple:
+            source.append('    return ({0},)'.format(', '.join(results)) if results else '    return ()')
+        else:
+            source.append('    return {0}'.format(results[0]))
+        namespace = {}
+        exec(compile('\n'.join(source), '<polynomial>', 'exec'), namespace)
+        return namespace['evaluate']
+
+    @staticmethod
+    def horner(coefficients, lines):
+        '''
+        Append the assignments evaluating {powers: coefficient} to lines and return the result expression.
+        The most frequent variable is factored out Horner-style,
+        x3*p3 + x*p1 + p0 becoming (p3*x**2 + p1)*x + p0,
+        with the coefficient polynomials p handled recursively in the other variables,
+        and its lowest power is extracted as a common factor.
+        '''
+        counts = {}
+        for powers in coefficients:
+            for k, _ in powers:
+                counts[k] = counts.get(k, 0) + 1
+        if not counts:
+            return str(sum(coefficients.values()))
+
+        variable = max(sorted(counts), key=counts.get)
+        groups = {}
+        for powers, coefficient in coefficients.items():
+            exponent = dict(powers).get(variable, 0)
+            groups.setdefault(exponent, {})[tuple((k, v) for k, v in powers if k != variable)] = coefficient
+        exponents = sorted(groups, reverse=True)
+
+        result = Polynomial.horner(groups[exponents[0]], lines)
+        for exponent, lower in zip(exponents, exponents[1:] + ([0] if exponents[-1] else [])):
+            factor = variable if exponent - lower == 1 else '{0}**{1}'.format(variable, exponent - lower)
+            expression = '{0}*{1}'.format(result, factor)
+            if lower in groups:
+                expression += '+{0}'.format(Polynomial.horner(groups[lower], lines))
+            result = '_{0}'.format(len(lines))
+            lines.append('{0} = {1}'.format(result, expression))
+        return result
+
+
+class Monomial(object):
+    '''
+    Interned product of variables, e.g. a2b is Monomial((('a', 2), ('b', 1))),
+    with the powers sorted by variable and no zero exponent.
+    Equal monomials are the same object, so they hash and compare by identity.
+    The ordering key of the terms is precomputed once per monomial.
+    The intern table holds monomials weakly, so those no longer used are freed.
+    '''
+
+    __slots__ = ('powers', 'key', '__weakref__')
+
+    INTERNED = weakref.WeakValueDictionary()
+
+    def __new__(cls, powers):
+        try:
+            return cls.INTERNED[powers]
+        except KeyError:
+            monomial = object.__new__(cls)
+            monomial.powers = powers
+            monomial.key = cls.get_key(powers)
+            cls.INTERNED[powers] = monomial
+            return monomial
+
+    def __reduce__(self):
+        return Monomial, (self.powers,)
+
+    @staticmethod
+    def get_key(powers):
+        key = 17
+        for k, v in powers:
+            for _ in range(v):
+                key = key * 31 + (128 - ord(k))
+        return key
+
+    @staticmethod
+    def from_variables(variables):
+        return Monomial(tuple(sorted((k, v) for k, v in variables.items() if v != 0)))
 
-        terms_ = [term for term in terms_ if term.coefficient != 0 or term.constant != 0]
-        if not terms_:
-            terms_ = [Term(None, coefficient=0, variables={}, constant=0)]
+    def multiply(self, monomial):
+        if not self.powers:
+            return monomial
+        if not monomial.powers:
+            return self
+        powers = dict(self.powers)
+        for k, v in monomial.powers:
+            powers[k] = powers.get(k, 0) + v
+        return Monomial(tuple(sorted(powers.items())))
 
-        return terms_
+
+class SpecializedPolynomial(object):
+    '''
+    Residual of a polynomial for a set of bound variables:
+    the terms are grouped by their monomial in the remaining variables,
+    and the coefficient of each group, a polynomial in the bound variables,
+    is compiled in Horner form into a single function.
+    Evaluation is one call of it for the coefficients of the residual monomials.
+    '''
+
+    def __init__(self, polynomial, bound):
+        groups = {}
+        for monomial, coefficient in polynomial.coefficients.items():
+            free = tuple((k, v) for k, v in monomial.powers if k not in bound)
+            powers = tuple((k, v) for k, v in monomial.powers if k in bound)
+            groups.setdefault(Monomial(free), {})[powers] = coefficient
+        self.monomials = list(groups.keys())
+        self.function = Polynomial.build_function([groups[monomial] for monomial in self.monomials],
+                                                  returns_tuple=True)
 
     def eval(self, params):
-        terms = sorted([term.eval(params) for term in self.terms], reverse=True)
-        terms = self.reduce(terms)
-        return Polynomial(None, terms=terms)
+        return Polynomial(None, coefficients=dict((monomial, coefficient)
+                                                  for monomial, coefficient in zip(self.monomials, self.function(params))
+                                                  if coefficient))
+
+
+class VectorizedPolynomial(object):
+    '''
+    Polynomial compiled once into dense arrays,
+    the integer coefficients and the (terms, variables) exponent matrix,
+    to evaluate many assignments in one vectorized pass.
+    Assignments binding only some variables give residual polynomials.
+    Values are computed in int64 when they provably fit, else as Python ints.
+    '''
+
+    INT64_LIMIT = 2 ** 62
+
+    def __init__(self, polynomial):
+        terms = [term for term in polynomial.terms if term.coefficient != 0 or term.constant != 0]
+        self.variables = sorted(set(k for term in terms for k in term.variables))
+        index = dict((k, i) for i, k in enumerate(self.variables))
+        self.coefficients = [term.coefficient if term.variables else term.constant for term in terms]
+        self.exponents = np.zeros((len(terms), len(self.variables)), dtype=np.int64)
+        for i, term in enumerate(terms):
+            for k, v in term.variables.items():
+                self.exponents[i, index[k]] = v
+
+    def get_dtype(self, bound_columns, values):
+        # Python ints, as abs(-2 ** 63) wraps around in int64.
+        max_values = [max(abs(int(values[:, j].max())), abs(int(values[:, j].min()))) if len(values) else 0
+                      for j in range(values.shape[1])]
+        limit = 0
+        for coefficient, exponents in zip(self.coefficients, self.exponents):
+            product = abs(coefficient)
+            for j, column in enumerate(bound_columns):
+                product *= max_values[j] ** int(exponents[column])
+            limit += product
+        return np.int64 if limit < self.INT64_LIMIT else object
+
+    def eval_matrix(self, variables, values):
+        '''
+        Evaluate the bound part of every term for each row of values,
+        whose columns are the given variables, and sum the terms
+        sharing the same unbound part.
+        Return the unbound variables, their exponent rows
+        and the (rows, residual monomials) coefficient matrix.
+        '''
+        values = np.asarray(values)
+        if values.size and (values.dtype.kind not in 'buiO' or values.dtype.kind == 'O' and
+                            not all(isinstance(v, (int, np.integer)) for v in values.flat)):
+            raise ValueError('Values must be integers, got {0}'.format(values.dtype))
+        bound = [k for k in self.variables if k in variables]
+        free = [k for k in self.variables if k not in variables]
+        bound_columns = [self.variables.index(k) for k in bound]
+        free_columns = [self.variables.index(k) for k in free]
+        values = values[:, [variables.index(k) for k in bound]]
+
+        dtype = self.get_dtype(bound_columns, values)
+        values = values.astype(dtype)
+        products = np.tile(np.array(self.coefficients, dtype=dtype), (len(values), 1))
+        for j, column in enumerate(bound_columns):
+            products *= values[:, j:j+1].astype(dtype) ** self.exponents[:, column].astype(dtype)
+
+        monomials, inverse = np.unique(self.exponents[:, free_columns], axis=0, return_inverse=True)
+        indicator = np.zeros((len(self.coefficients), len(monomials)), dtype=dtype)
+        indicator[np.arange(len(self.coefficients)), inverse.ravel()] = 1
+        return free, monomials, products.dot(indicator)
+
+    def values(self, variables, values):
+        free, _, residuals = self.eval_matrix(variables, values)
+        if free:
+            raise ValueError('Unbound variables: {0}'.format(','.join(free)))
+        return residuals.sum(axis=1)
+
+    def polynomials(self, variables, values):
+        free, monomials, residuals = self.eval_matrix(variables, values)
+        monomial_variables = [dict((k, int(v)) for k, v in zip(free, monomial) if v) for monomial in monomials]
+        polynomials = []
+        for row in residuals:
+            terms = []
+            for variables_, coefficient in zip(monomial_variables, row):
+                if coefficient == 0:
+                    continue
+                if variables_:
+                    terms.append(Term(None, coefficient=int(coefficient), variables=variables_, constant=0))
+                else:
+                    terms.append(Term(None, coefficient=0, variables={}, constant=int(coefficient)))
+            terms = Polynomial.reduce(sorted(terms, reverse=True) or [Term('0')])
+            polynomials.append(Polynomial(None, terms=terms))
+        return polynomials
+
+    def eval_params(self, params_list):
+        '''
+        Evaluate a list of parameter dicts, grouped by the set of bound variables.
+        '''
+        groups = {}
+        for index, params in enumerate(params_list):
+            bound = tuple(k for k in self.variables if k in params)
+            groups.setdefault(bound, []).append(index)
+
+        polynomials = [None] * len(params_list)
+        for bound, indexes in groups.items():
+            values = np.array([[params_list[index][k] for k in bound] for index in indexes],
+                              dtype=object).reshape(len(indexes), len(bound))
+            for index, polynomial in zip(indexes, self.polynomials(list(bound), values)):
+                polynomials[index] = polynomial
+        return polynomials
 
 
 class Term(object):
+    __slots__ = ('coefficient', 'monomial', 'constant', '_expression')
+
+    LAST_FACTOR = re.compile(r"^(.*?)([a-z][0-9]*|[0-9]+)$")
+
     def __init__(self, expression=None, **kwargs):
-        self.coefficient = 0
-        self.variables = {}
-        self.constant = 0
         if expression:
-            self.coefficient, self.variables, self.constant = self.parse(expression)
+            coefficient, variables, self.constant = self.parse(expression)
         else:
-            self.coefficient = kwargs.get('coefficient', 0)
-            self.variables = kwargs.get('variables', {})
+            coefficient = kwargs.get('coefficient', 0)
+            variables = kwargs.get('variables', {})
             self.constant = kwargs.get('constant', 0)
-        self.expression = self.__str__()
+        self.monomial = Monomial.from_variables(variables) if coefficient != 0 else Monomial(())
+        self.coefficient = coefficient if self.monomial.powers else 0
+        self._expression = None
+
+    @staticmethod
+    def from_monomial(monomial, coefficient):
+        if monomial.powers:
+            return Term(None, coefficient=coefficient, variables=dict(monomial.powers), constant=0)
+        return Term(None, coefficient=0, variables={}, constant=coefficient)
+
+    @property
+    def variables(self):
+        return dict(self.monomial.powers)
+
+    @property
+    def sort_key(self):
+        if self.monomial.powers:
+            return 1, self.monomial.key, self.coefficient
+        return 0, 0, self.constant
 
     def __str__(self):
-        expression = ''
-        if not -1 <= self.coefficient <= 1:
-            expression += str(self.coefficient)
-        if self.coefficient == -1:
-            expression += '-'
+        return self.expression
+
+    @property
+    def expression(self):
+        if self._expression is None:
+            self._expression = self.render()
+        return self._expression
+
+    def render(self):
+        parts = []
         if self.coefficient != 0:
-            for k, v in sorted(self.variables.items()):
-                if v != 0:
-                    expression += k
-                    if v != 1:
-                        expression += str(v)
-        if self.constant != 0 or not expression:
-            expression += str(self.constant)
-        return expression
+            self.render_parts(parts, self.coefficient, self.monomial.powers)
+        if self.constant != 0 or not parts:
+            parts.append(str(self.constant))
+        return ''.join(parts)
+
+    @staticmethod
+    def render_parts(parts, coefficient, powers):
+        if not powers:
+            parts.append(str(coefficient))
+            return
+        if coefficient == -1:
+            parts.append('-')
+        elif coefficient != 1:
+            parts.append(str(coefficient))
+        for k, v in powers:
+            parts.append(k)
+            if v != 1:
+                parts.append(str(v))
 
     def __eq__(self, term):
         if self is term:
             return True
         elif not isinstance(term, self.__class__):
             return False
-        elif self.coefficient == term.coefficient and \
-             self.variables == term.variables and \
-             self.constant == term.constant:
-            return True
         else:
-            return False
+            return self.coefficient == term.coefficient and \
+                   self.monomial is term.monomial and \
+                   self.constant == term.constant
 
     def __hash__(self):
-        result = 17
-        result = result * 31 + self.coefficient
-        for k, v in sorted(self.variables.items()):
-            result = result * 31 +  ord(k) * v
-        result = result * 31 + self.constant
-        return result
+        return hash((self.coefficient, self.monomial.powers, self.constant))
 
     def __lt__(self, term):
-        if self.variables and term.variables:
-            count0 = 17
-            for k, v in sorted(self.variables.items()):
-                for _ in range(v):
-                    count0 = count0 * 31 + (128 - ord(k))
-
-            count1 = 17
-            for k, v in sorted(term.variables.items()):
-                for _ in range(v):
-                    count1 = count1 * 31 + (128 - ord(k))
-
-            if count0 < count1:
-                return True
-            elif count0 > count1:
-                return False
-            else:
-                if self.coefficient < term.coefficient:
-                    return True
-                else:
-                    return False
-        elif self.variables and not term.variables:
-            return False
-        elif not self.variables and term.variables:
-            return True
-        else:
-            if self.constant < term.constant:
-                return True
-            else:
-                return False
+        return self.sort_key < term.sort_key
 
     def __le__(self, term):
-        if self.variables and term.variables:
-            count0 = 17
-            for k, v in sorted(self.variables.items()):
-                for _ in range(v):
-                    count0 = count0 * 31 + (128 - ord(k))
-
-            count1 = 17
-            for k, v in sorted(term.variables.items()):
-                for _ in range(v):
-                    count1 = count1 * 31 + (128 - ord(k))
-
-            if count0 < count1:
-                return True
-            elif count0 > count1:
-                return False
-            else:
-                if self.coefficient <= term.coefficient:
-                    return True
-                else:
-                    return False
-        elif self.variables and not term.variables:
-            return False
-        elif not self.variables and term.variables:
-            return True
-        else:
-            if self.constant <= term.constant:
-                return True
-            else:
-                return False
+        return self.sort_key <= term.sort_key
 
     @staticmethod
     def parse(expression):
@@ -392,68 +818,53 @@ class Term(object):
         if any(x.isalpha() for x in normalized_elements):
             variables = {}
             for i in range(int(len(normalized_elements)/2)):
-                variables[normalized_elements[i*2+1]] = int(normalized_elements[i*2+2])
+                k = normalized_elements[i*2+1]
+                variables[k] = variables.get(k, 0) + int(normalized_elements[i*2+2])
             return int(normalized_elements[0]), variables, 0
         else:
             return 0, {}, int(normalized_elements[0])
 
     def add(self, term):
-        if self.variables == term.variables:
-            if self.variables:
-                coefficient = self.coefficient + term.coefficient
-                if coefficient == 0:
-                    return Term(None, coefficient=0, variables={}, constant=0)
-                else:
-                    return Term(None, coefficient=coefficient, variables=self.variables, constant=0)
+        if self.monomial is term.monomial:
+            if self.monomial.powers:
+                return Term.from_monomial(self.monomial, self.coefficient + term.coefficient) \
+                    if self.coefficient + term.coefficient else Term('0')
             else:
                 return Term(None, coefficient=0, variables={}, constant=self.constant + term.constant)
         else:
             return Polynomial(None, terms=[self, term])
 
     def subtract(self, term):
-        if self.variables == term.variables:
-            if self.variables:
-                coefficient = self.coefficient - term.coefficient
-                if coefficient == 0:
-                    return Term(None, coefficient=0, variables={}, constant=0)
-                else:
-                    return Term(None, coefficient=coefficient, variables=self.variables, constant=0)
-            else:
-                return Term(None, coefficient=0, variables={}, constant=self.constant - term.constant)
-        else:
-            term_ = Term(None, coefficient=-term.coefficient, variables=term.variables, constant=term.constant)
-            return Polynomial(None, terms=[self, term_])
+        return self.add(term.multiply(Term('-1')))
 
     def multiply(self, term):
-        if self.variables and term.variables:
-            coefficient = self.coefficient * term.coefficient
-            variables = {k: self.variables.get(k, 0) + term.variables.get(k, 0)
-                         for k in set(self.variables) | set(term.variables)}
-            return Term(None, coefficient=coefficient, variables=variables, constant=0)
-        elif self.variables and not term.variables:
-            coefficient = self.coefficient * term.constant
-            return Term(None, coefficient=coefficient, variables=self.variables, constant=0)
-        elif not self.variables and term.variables:
-            coefficient = self.constant * term.coefficient
-            return Term(None, coefficient=coefficient, variables=term.variables, constant=0)
-        else:
-            constant = self.constant * term.constant
-            return Term(None, coefficient=0, variables={}, constant=constant)
+        coefficient = (self.coefficient or self.constant) * (term.coefficient or term.constant)
+        return Term.from_monomial(self.monomial.multiply(term.monomial), coefficient)
+
+    def power(self, exponent):
+        coefficient = (self.coefficient or self.constant) ** exponent
+        return Term.from_monomial(Monomial.from_variables(dict((k, v * exponent) for k, v in self.monomial.powers)),
+                                  coefficient)
+
+    @staticmethod
+    def power_literal(literal, exponent):
+        '''
+        Raise the last factor of a literal to the power, e.g. 2ab^2 is 2ab2.
+        '''
+        head, factor = Term.LAST_FACTOR.match(literal).groups()
+        term = Term(factor).power(exponent)
+        return Term(head).multiply(term) if head else term
 
     def eval(self, params):
-        if self.variables:
-            coefficient = self.coefficient
-            variables = deepcopy(self.variables)
-            for k, v in sorted(variables.items()):
-                if k in params.keys():
-                    coefficient *= params[k] ** v
-                    variables.pop(k)
-            if variables:
-                return Term(None, coefficient=coefficient, variables=variables, constant=0)
+        coefficient = self.coefficient or self.constant
+        variables = {}
+        for k, v in self.monomial.powers:
+            if k in params:
+                coefficient *= params[k] ** v
             else:
-                return Term(None, coefficient=0, variables={}, constant=coefficient)
-        else:
-            return deepcopy(self)
+                variables[k] = v
+        return Term.from_monomial(Monomial.from_variables(variables), coefficient)
+
 
 if __name__ == '__main__':
     expression = 'a+4-b+(12+(10+c)+d)+((2*e)+3*f)'
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+
+from __future__ import print_function, division
+import collections
+import io
+import itertools
+import multiprocessing
+import sys
+from q2 import Algebra
+
+__author__ = 'Ben Lai'
+__email__ = "laichunpongben@gmail.com"
+
+
+_algebras = {}
+
+
+def _eval_chunk(task):
+    expression, param_strs = task
+    try:
+        algebra = _algebras[expression]
+    except KeyError:
+        algebra = Algebra(expression)
+        _algebras[expression] = algebra
+    return [str(algebra.eval_str(param_str)) for param_str in param_strs]
+
+
+class BatchEvaluator(object):
+    '''
+    Evaluate q2 input files, an expression followed by a blank line
+    and one assignment per line, streaming the assignments in chunks
+    across a process pool. Each worker parses an expression once.
+    At most max_pending chunks are in flight, so memory stays flat
+    whatever the input size, and the results are written in input order.
+    '''
+
+    def __init__(self, **kwargs):
+        self.processes = kwargs.get('processes', None)
+        self.chunk_size = kwargs.get('chunk_size', 10000)
+        self.max_pending = kwargs.get('max_pending', None)  # 2 chunks per process if None
+
+    @staticmethod
+    def read_tasks(path, chunk_size):
+        with open(path, 'r') as f:
+            expression = f.readline().strip()
+            param_strs = (line.strip() for line in f)
+            param_strs = (param_str for param_str in param_strs if param_str)
+            while True:
+                chunk = list(itertools.islice(param_strs, chunk_size))
+                if not chunk:
+                    break
+                yield expression, chunk
+
+    def tasks(self, paths):
+        for path in paths:
+            for task in self.read_tasks(path, self.chunk_size):
+                yield task
+
+    @staticmethod
+    def write(output, results):
+        output.write(''.join('{0}\n'.format(result) for result in results))
+
+    def run(self, paths, output):
+        if self.processes == 1:
+            for task in self.tasks(paths):
+                self.write(output, _eval_chunk(task))
+            return
+
+        max_pending = self.max_pending or 2 * (self.processes or multiprocessing.cpu_count())
+        pending = collections.deque()
+        with multiprocessing.Pool(self.processes) as pool:
+            for task in self.tasks(paths):
+                if len(pending) >= max_pending:
+                    self.write(output, pending.popleft().get())
+                pending.append(pool.apply_async(_eval_chunk, (task,)))
+            while pending:
+                self.write(output, pending.popleft().get())
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Evaluate q2 expression and parameter files.')
+    parser.add_argument('inputs', nargs='+',
+                        help='input files, an expression, a blank line and one assignment per line')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file, - for stdout')
+    parser.add_argument('-p', '--processes', type=int, default=None,
+                        help='worker processes, 1 to evaluate in-process')
+    parser.add_argument('-c', '--chunk-size', type=int, default=10000,
+                        help='assignments per chunk')
+    parser.add_argument('-b', '--buffer-size', type=int, default=1 << 20,
+                        help='output buffer size in bytes')
+
+    args = parser.parse_args()
+
+    evaluator = BatchEvaluator(processes=args.processes, chunk_size=args.chunk_size)
+    if args.output == '-':
+        evaluator.run(args.inputs, sys.stdout)
+    else:
+        with io.open(args.output, 'w', buffering=args.buffer_size) as output:
+            evaluator.run(args.inputs, output)
@@ -1,9 +1,14 @@
 #!/usr/bin/python3
 
 from __future__ import print_function, division
+import math
+import multiprocessing
 import string
 import random
 from collections import Counter
+from queue import Empty
+import numpy as np
+from ga_utils import NullTelemetry, GenerationTelemetry, FitnessCache, save_checkpoint, load_checkpoint
 
 __author__ = 'Ben Lai'
 __email__ = "laichunpongben@gmail.com"
@@ -13,17 +18,31 @@ class SubstitutionCipherSolver(object):
     '''
     Apply genetic algorithm to find the key of the substitution cipher.
     Fitness is defined by the ratio of decrypted words found in the dictionary.
-    Alternatively, if a dictionary is not available,
-    fitness can be defined by 1 - cross-entropy
-    of letters against a common distribution. (NotImplemented)
+    The cipher text is reduced once to its distinct words and their counts,
+    so scoring a key only translates the vocabulary, looked up in a hashed index.
+    Alternatively, solve(method='patterns') matches cipher words to dictionary words
+    of the same letter-repetition pattern and searches the key by backtracking,
+    and solve(method='anneal') runs simulated annealing over letter swaps.
+    If a dictionary is not available, fitness_method='ngrams'
+    defines fitness by 1 - H / H_uniform, where H is the cross-entropy of the
+    decrypted letter n-grams against the n-gram distribution of a corpus text
+    and H_uniform that of uniformly random letters.
+    The distinct cipher n-grams and their counts are computed once,
+    and scoring a key maps them through its inverse into the log-probability table.
     If the key is not found in a run,
     try re-run with different parameters
-    such as chromosome_size and max_no_update_generation.
+    such as chromosome_size and max_no_update_generation,
+    or let ParallelCipherSolver run them in parallel.
+    Setting stop_event stops any of the solvers at its next check.
     '''
 
+    STOP_CHECK_STEPS = 1000
+
     def __init__(self, cipher_text, words, **kwargs):
         self.cipher_text = cipher_text
         self.words = words
+        self.word_index = set(words)
+        self.pattern_index = self.index_patterns(self.word_index)
         self.plain_text = ''
         self.max_generation = kwargs.get('max_generation', 1000)
         self.chromosome_size = kwargs.get('chromosome_size', 40)  # must be even int
@@ -33,8 +52,32 @@ class SubstitutionCipherSolver(object):
         self.chromosomes = [self.shuffle(string.ascii_lowercase) for _ in range(self.chromosome_size)]
         self.non_ascii_letter_key = self.get_non_ascii_letter_key(self.cipher_text)
         self.normalized_cipher_text = self.normalize_text(self.cipher_text)
+        self.cipher_words = self.count_words(self.normalized_cipher_text)
         self.alphabet = self.extend(string.ascii_lowercase)
+        self.best_key = string.ascii_lowercase
+        self.best_fitness = 0.0
+        self.generation = 0
         self.last_updated_generation = 0
+        self.evaluations = 0
+        self.telemetry = kwargs.get('telemetry', NullTelemetry())
+        self.checkpoint_path = kwargs.get('checkpoint_path', None)
+        self.checkpoint_every = kwargs.get('checkpoint_every', 100)
+        self.fitness_cache = FitnessCache(kwargs.get('fitness_cache_size', 10000))
+        self.max_nodes = kwargs.get('max_nodes', 100000)
+        self.restarts = kwargs.get('restarts', 20)
+        self.max_no_update_restarts = kwargs.get('max_no_update_restarts', 3)
+        self.anneal_steps = kwargs.get('anneal_steps', 20000)
+        self.start_temperature = kwargs.get('start_temperature', 0.002)
+        self.stop_event = kwargs.get('stop_event', None)
+        self.stopped_others = False
+        self.fitness_method = kwargs.get('fitness_method', 'words')
+        if self.fitness_method not in ('words', 'ngrams'):
+            raise ValueError('Unknown fitness method: {0}'.format(self.fitness_method))
+        self.ngram_size = kwargs.get('ngram_size', 2)
+        if self.fitness_method == 'ngrams':
+            corpus_words = self.count_words(self.normalize_text(kwargs.get('corpus', ' '.join(words))))
+            self.ngram_log_probabilities = self.get_ngram_log_probabilities(corpus_words, self.ngram_size)
+            self.ngram_codes, self.ngram_counts = self.count_ngrams(self.cipher_words, self.ngram_size)
 
     @staticmethod
     def get_non_ascii_letter_key(text):
@@ -86,14 +129,78 @@ class SubstitutionCipherSolver(object):
         text_ = self.remove_digits(text_)
         return text_
 
+    @staticmethod
+    def count_words(normalized_text):
+        return Counter(word for word in normalized_text.split(' ') if word)
+
+    @staticmethod
+    def word_pattern(word):
+        '''
+        Letter-repetition pattern of a word, e.g. hello is ABCCD.
+        '''
+        letters = {}
+        return ''.join(letters.setdefault(c, string.ascii_uppercase[len(letters)]) for c in word)
+
+    @staticmethod
+    def index_patterns(words):
+        pattern_index = {}
+        for word in sorted(words):
+            if word and set(word) <= set(string.ascii_lowercase):
+                pattern_index.setdefault(SubstitutionCipherSolver.word_pattern(word), []).append(word)
+        return pattern_index
+
     def fitness(self, normalized_decrypted_text):
-        count = 0
-        decrypted_words = [word for word in list(set(normalized_decrypted_text.split(' '))) if word]
-        for word in decrypted_words:
-            if word in self.words:
-                count += 1
+        decrypted_words = self.count_words(normalized_decrypted_text)
+        count = sum(1 for word in decrypted_words if word in self.word_index)
+        return count / len(self.words)
+
+    def key_fitness(self, key):
+        return self.fitness_cache.get(key, self.compute_key_fitness)
+
+    def compute_key_fitness(self, key):
+        if self.fitness_method == 'ngrams':
+            return self.compute_ngram_fitness(key)
+        # A key is a bijection, so distinct cipher words decrypt to distinct words.
+        table = str.maketrans(self.extend(key), self.alphabet)
+        count = sum(1 for word in self.cipher_words if word.translate(table) in self.word_index)
         return count / len(self.words)
 
+    @staticmethod
+    def count_ngrams(words, n):
+        '''
+        Distinct letter n-grams within the words, weighted by the word counts,
+        as a (ngrams, n) array of letter indexes and an array of counts.
+        '''
+        counts = Counter()
+        for word, count in words.items():
+            if set(word) <= set(string.ascii_lowercase):
+                for i in range(len(word) - n + 1):
+                    counts[word[i:i+n]] += count
+        ngrams = sorted(counts)
+        codes = np.array([[ord(c) - ord('a') for c in ngram] for ngram in ngrams], dtype=np.intp)
+        return codes.reshape(len(ngrams), n), np.array([counts[ngram] for ngram in ngrams], dtype=np.float64)
+
+    @staticmethod
+    def ngram_index(codes):
+        return codes.dot(len(string.ascii_lowercase) ** np.arange(codes.shape[1] - 1, -1, -1))
+
+    @staticmethod
+    def get_ngram_log_probabilities(words, n):
+        codes, counts = SubstitutionCipherSolver.count_ngrams(words, n)
+        table = np.ones(len(string.ascii_lowercase) ** n)  # add-one smoothing
+        np.add.at(table, SubstitutionCipherSolver.ngram_index(codes), counts)
+        return np.log(table / table.sum())
+
+    def compute_ngram_fitness(self, key):
+        total = self.ngram_counts.sum()
+        if not total:
+            return 0.0
+        inverse = np.empty(len(string.ascii_lowercase), dtype=np.intp)
+        inverse[[ord(c) - ord('a') for c in key]] = np.arange(len(string.ascii_lowercase))
+        log_likelihood = self.ngram_counts.dot(self.ngram_log_probabilities[self.ngram_index(inverse[self.ngram_codes])])
+        cross_entropy = -log_likelihood / total
+        return 1 - cross_entropy / (self.ngram_size * math.log(len(string.ascii_lowercase)))
+
     def crossover(self, key0, key1):
         len_key = len(string.ascii_lowercase)
         index = int(random.uniform(0, 1) * len_key)
@@ -122,14 +229,245 @@ class SubstitutionCipherSolver(object):
             key = key[:index] + missing_chars[i] + key[index+1:]
         return key
 
-    def solve(self):
-        best_key = string.ascii_lowercase
-        best_fitness = 0.0
-        for i in range(self.max_generation):
+    def get_state(self):
+        return {
+            'chromosomes': self.chromosomes,
+            'best_key': self.best_key,
+            'best_fitness': self.best_fitness,
+            'generation': self.generation,
+            'last_updated_generation': self.last_updated_generation,
+            'evaluations': self.evaluations,
+        }
+
+    def set_state(self, state):
+        self.chromosomes = state['chromosomes']
+        self.best_key = state['best_key']
+        self.best_fitness = state['best_fitness']
+        self.generation = state['generation']
+        self.last_updated_generation = state['last_updated_generation']
+        self.evaluations = state['evaluations']
+
+    def save_checkpoint(self, path):
+        save_checkpoint(path, self.get_state())
+
+    def is_stopped(self):
+        '''
+        With a stop_event, reaching success_threshold sets it,
+        so that the other runs sharing the event stop.
+        The run which set it carries on to its own stop conditions.
+        '''
+        if self.stop_event is None or self.stopped_others:
+            return False
+        if self.stop_event.is_set():
+            return True
+        if self.best_fitness >= self.success_threshold:
+            self.stop_event.set()
+            self.stopped_others = True
+        return False
+
+    def solve(self, method='ga', resume_from=None):
+        solvers = {
+            'ga': self.solve_ga,
+            'patterns': self.solve_patterns,
+            'anneal': self.solve_anneal,
+        }
+        if method not in solvers:
+            raise ValueError('Unknown method: {0}'.format(method))
+        if resume_from is not None:
+            self.set_state(load_checkpoint(resume_from))
+        return solvers[method]()
+
+    def solve_patterns(self):
+        '''
+        Constraint propagation and backtracking over word patterns.
+        Each distinct cipher word may decrypt to the dictionary words of its pattern
+        which agree with the partial key. Words whose letters are all decided
+        are counted at once; of the rest, the word with the fewest candidates
+        is branched on, trying each candidate and then leaving it unmatched.
+        A branch is pruned when even matching all its viable words
+        cannot beat the best partial key. The search stops after max_nodes branches.
+        '''
+        cipher_to_plain = {}
+        plain_to_cipher = {}
+        candidates = dict((word, self.pattern_index.get(self.word_pattern(word), []))
+                          for word in self.cipher_words if set(word) <= set(string.ascii_lowercase))
+        best = {'matched': -1, 'mapping': {}}
+
+        def consistent(cipher_word, plain_word):
+            return all(cipher_to_plain.get(c, p) == p and plain_to_cipher.get(p, c) == c
+                       for c, p in zip(cipher_word, plain_word))
+
+        def expand(remaining, matched):
+            viable = {}
+            for word in remaining:
+                if all(c in cipher_to_plain for c in word):
+                    matched += ''.join(cipher_to_plain[c] for c in word) in self.word_index
+                else:
+                    options = [plain_word for plain_word in candidates[word] if consistent(word, plain_word)]
+                    if options:
+                        viable[word] = options
+            if matched > best['matched']:
+                best['matched'], best['mapping'] = matched, dict(plain_to_cipher)
+            if not viable or matched + len(viable) <= best['matched']:
+                return None
+            word = min(sorted(viable), key=lambda w: (len(viable[w]), -len(set(w))))
+            rest = [w for w in viable if w != word]
+            return [word, iter(viable[word] + [None]), rest, matched, []]
+
+        stack = [expand(list(candidates), 0)]
+        nodes = 0
+        while stack and stack[-1] is not None and nodes < self.max_nodes:
+            word, choices, rest, matched, assigned = stack[-1]
+            for c in assigned:
+                del plain_to_cipher[cipher_to_plain.pop(c)]
+            del assigned[:]
+            plain_word = next(choices, False)
+            if plain_word is False:
+                stack.pop()
+                continue
+            nodes += 1
+            if nodes % self.STOP_CHECK_STEPS == 0 and self.is_stopped():
+                break
+            if plain_word is not None:
+                for c, p in zip(word, plain_word):
+                    if c not in cipher_to_plain:
+                        cipher_to_plain[c], plain_to_cipher[p] = p, c
+                        assigned.append(c)
+            frame = expand(rest, matched + (plain_word is not None))
+            if frame is not None:
+                stack.append(frame)
+
+        mapping = best['mapping']
+        spare = iter(sorted(set(string.ascii_lowercase).difference(mapping.values())))
+        key = ''.join(mapping[p] if p in mapping else next(spare) for p in string.ascii_lowercase)
+        fitness = self.key_fitness(key)
+        self.evaluations += nodes
+        if fitness > self.best_fitness:
+            self.best_key, self.best_fitness = key, fitness
+
+        return key, fitness
+
+    def get_score_units(self):
+        '''
+        Split the fitness into per-unit contributions, the distinct cipher words
+        or n-grams, so that fitness = offset + scale * sum of contributions.
+        The inverse key, from cipher to plain letter indexes, is held by the scorer.
+        Return the units as lists of letter indexes, a function setting the inverse key,
+        a function swapping two of its letters in place, a function computing
+        the contributions of the given units under it, offset and scale.
+        '''
+        size = len(string.ascii_lowercase)
+        if self.fitness_method == 'ngrams':
+            codes = self.ngram_codes
+            total = self.ngram_counts.sum()
+            inverse = np.arange(size, dtype=np.intp)
+
+            def set_inverse(key):
+                inverse[:] = key
+
+            def swap(c0, c1):
+                inverse[c0], inverse[c1] = inverse[c1], inverse[c0]
+
+            def contributions(indexes):
+                indexes = np.array(indexes, dtype=np.intp)
+                return (self.ngram_counts[indexes] *
+                        self.ngram_log_probabilities[self.ngram_index(inverse[codes[indexes]])]).tolist()
+
+            scale = 1 / (total * self.ngram_size * math.log(size)) if total else 0.0
+            return codes.tolist(), set_inverse, swap, contributions, 1.0 if total else 0.0, scale
+
+        # Keys only permute lowercase letters, so bytes translate through one table.
+        words = [word for word in self.cipher_words if set(word) <= set(string.ascii_lowercase)]
+        cipher_words = [word.encode('ascii') for word in words]
+        plain_words = set(word.encode('ascii') for word in self.word_index
+                          if set(word) <= set(string.ascii_lowercase))
+        letters = string.ascii_lowercase.encode('ascii')
+        table = bytearray(range(256))
+
+        def set_inverse(key):
+            for c, p in enumerate(key):
+                table[letters[c]] = letters[p]
+
+        def swap(c0, c1):
+            o0, o1 = letters[c0], letters[c1]
+            table[o0], table[o1] = table[o1], table[o0]
+
+        def contributions(indexes):
+            return [word.translate(table) in plain_words for word in map(cipher_words.__getitem__, indexes)]
+
+        units = [[ord(c) - ord('a') for c in word] for word in words]
+        return units, set_inverse, swap, contributions, 0.0, 1 / len(self.words)
+
+    def solve_anneal(self):
+        '''
+        Simulated annealing over swaps of two letters, restarted from random keys.
+        The temperature falls linearly from start_temperature to 0 in anneal_steps.
+        Contributions of the cipher words or n-grams are kept per unit
+        and indexed by the cipher letters they contain,
+        so a swap rescores only the units containing either letter.
+        Restarting stops after max_no_update_restarts restarts without improvement.
+        '''
+        size = len(string.ascii_lowercase)
+        units, set_inverse, swap, contributions, offset, scale = self.get_score_units()
+        letter_units = [set() for _ in range(size)]
+        for i, unit in enumerate(units):
+            for c in unit:
+                letter_units[c].add(i)
+        all_units = range(len(units))
+
+        self.telemetry.start(0, self.evaluations)
+        last_updated_restart = 0
+        for restart in range(self.restarts):
+            inverse = random.sample(range(size), size)
+            set_inverse(inverse)
+            scores = contributions(all_units)
+            score = sum(scores)
+            best_score, best_inverse = score, list(inverse)
+            steps = 0
+            while steps < self.anneal_steps:
+                if steps % self.STOP_CHECK_STEPS == 0 and self.is_stopped():
+                    break
+                temperature = self.start_temperature * (1 - steps / self.anneal_steps)
+                steps += 1
+                c0, c1 = random.sample(range(size), 2)
+                indexes = list(letter_units[c0] | letter_units[c1])
+                swap(c0, c1)
+                new_scores = contributions(indexes)
+                delta = sum(new_scores) - sum(map(scores.__getitem__, indexes))
+                if delta >= 0 or random.random() < math.exp(delta * scale / temperature):
+                    for i, new_score in zip(indexes, new_scores):
+                        scores[i] = new_score
+                    inverse[c0], inverse[c1] = inverse[c1], inverse[c0]
+                    score += delta
+                    if score > best_score:
+                        best_score, best_inverse = score, list(inverse)
+                else:
+                    swap(c0, c1)
+            self.evaluations += steps
+
+            key = [''] * size
+            for c, p in enumerate(best_inverse):
+                key[p] = string.ascii_lowercase[c]
+            key = ''.join(key)
+            fitness = self.key_fitness(key)
+            if self.telemetry.sample(restart):
+                self.telemetry.record(restart, key, fitness, offset + scale * score, self.evaluations)
+            if fitness > self.best_fitness:
+                self.best_key, self.best_fitness = key, fitness
+                last_updated_restart = restart
+            if self.best_fitness >= 1.0 or self.is_stopped():
+                break
+            if restart - last_updated_restart >= self.max_no_update_restarts:
+                break
+
+        return self.best_key, self.best_fitness
+
+    def solve_ga(self):
+        self.telemetry.start(self.generation, self.evaluations)
+        for i in range(self.generation, self.max_generation):
             key_fitnesses = []
             for key in self.chromosomes:
-                normalized_decrypted_text = self.decrypt(key, self.normalized_cipher_text)
-                fitness = self.fitness(normalized_decrypted_text)
+                fitness = self.key_fitness(key)
                 key_fitnesses.append((key, fitness))
             random.shuffle(key_fitnesses)
 
@@ -137,25 +475,124 @@ class SubstitutionCipherSolver(object):
                 children_keys = self.crossover(key_fitnesses[j*2][0], key_fitnesses[j*2+1][0])
                 for key in children_keys:
                     key = self.mutate(key)
-                    normalized_decrypted_text = self.decrypt(key, self.normalized_cipher_text)
-                    fitness = self.fitness(normalized_decrypted_text)
+                    fitness = self.key_fitness(key)
                     key_fitnesses.append((key, fitness))
+            self.evaluations += len(key_fitnesses)
             key_fitnesses.sort(key=lambda x: -x[1])
             self.chromosomes = list(list(zip(*key_fitnesses))[0])[:self.chromosome_size]
+            self.generation = i + 1
             best_trial_fitness = key_fitnesses[0][1]
 
-            print('Generation {0}: {1} {2}'.format(i, key_fitnesses[0][0], key_fitnesses[0][1]))
-            if best_trial_fitness > best_fitness:
-                best_key, best_fitness = key_fitnesses[0][0], key_fitnesses[0][1]
+            if self.telemetry.sample(i):
+                fitnesses = [fitness for _, fitness in key_fitnesses[:self.chromosome_size]]
+                self.telemetry.record(i, key_fitnesses[0][0], best_trial_fitness,
+                                      sum(fitnesses) / len(fitnesses), self.evaluations)
+            if best_trial_fitness > self.best_fitness:
+                self.best_key, self.best_fitness = key_fitnesses[0][0], key_fitnesses[0][1]
                 self.last_updated_generation = i
 
-            if best_fitness >= 1.0:
+            if self.checkpoint_path and self.generation % self.checkpoint_every == 0:
+                self.save_checkpoint(self.checkpoint_path)
+
+            if self.best_fitness >= 1.0 or self.is_stopped():
                 break
 
             if i - self.last_updated_generation > self.max_no_update_generation:
                 break
 
-        return best_key, best_fitness
+        return self.best_key, self.best_fitness
+
+
+class ParallelCipherSolver(object):
+    '''
+    Run seeded SubstitutionCipherSolver restarts across a process pool,
+    each run with its own solver parameters (and optionally its own method).
+    The telemetry records of every run, tagged with the run index,
+    are streamed to callback as they arrive.
+    As soon as a run reaches its success_threshold, the runs not started yet
+    are skipped and the other running ones are stopped through a shared event.
+    Runs without their own success_threshold use success_threshold,
+    which suits the default word fitness; with fitness_method='ngrams'
+    the reachable fitness depends on the corpus, so set it per run.
+    '''
+
+    def __init__(self, cipher_text, words, **kwargs):
+        self.cipher_text = cipher_text
+        self.words = words
+        self.runs = kwargs.get('runs', [{} for _ in range(multiprocessing.cpu_count())])
+        self.method = kwargs.get('method', 'ga')
+        self.success_threshold = kwargs.get('success_threshold', 0.9)
+        self.processes = kwargs.get('processes', None)
+        self.report_every = kwargs.get('report_every', 10)
+        self.callback = kwargs.get('callback', None)
+        self.results = []
+        self.best_key = string.ascii_lowercase
+        self.best_fitness = 0.0
+
+    def drain(self, queue, timeout):
+        try:
+            while True:
+                record = queue.get(timeout=timeout)
+                if self.callback is not None:
+                    self.callback(record)
+        except Empty:
+            pass
+
+    def solve(self):
+        tasks = []
+        for index, run in enumerate(self.runs):
+            solver_kwargs = dict(run)
+            method = solver_kwargs.pop('method', self.method)
+            solver_kwargs.setdefault('success_threshold', self.success_threshold)
+            tasks.append((index, random.getrandbits(32), method, self.report_every, solver_kwargs))
+
+        queue = multiprocessing.Queue()
+        stop_event = multiprocessing.Event()
+        with multiprocessing.Pool(self.processes, initializer=_init_restart,
+                                  initargs=(self.cipher_text, self.words, queue, stop_event)) as pool:
+            pending = [pool.apply_async(_solve_restart, (task,)) for task in tasks]
+            while pending:
+                self.drain(queue, 0.05)
+                for result in [result for result in pending if result.ready()]:
+                    pending.remove(result)
+                    self.results.append(result.get())
+            self.drain(queue, 0.1)
+
+        self.results.sort(key=lambda result: result['run'])
+        for result in self.results:
+            if result['best_fitness'] > self.best_fitness:
+                self.best_key, self.best_fitness = result['best_key'], result['best_fitness']
+
+        return self.best_key, self.best_fitness
+
+
+_restart_args = None
+
+
+def _init_restart(cipher_text, words, queue, stop_event):
+    global _restart_args
+    _restart_args = cipher_text, words, queue, stop_event
+
+
+def _solve_restart(task):
+    index, seed, method, report_every, solver_kwargs = task
+    cipher_text, words, queue, stop_event = _restart_args
+    result = {'run': index, 'seed': seed, 'best_key': None, 'best_fitness': 0.0, 'evaluations': 0}
+    if stop_event.is_set():
+        return result
+
+    random.seed(seed)
+
+    def report(record):
+        queue.put(dict(record, run=index))
+
+    solver = SubstitutionCipherSolver(cipher_text, words, stop_event=stop_event,
+                                      telemetry=GenerationTelemetry(every=report_every, callback=report),
+                                      **solver_kwargs)
+    key, fitness = solver.solve(method)
+    if fitness >= solver.success_threshold:
+        stop_event.set()
+    return dict(result, best_key=key, best_fitness=fitness, evaluations=solver.evaluations)
 
 if __name__ == '__main__':
     import time
@@ -173,7 +610,8 @@ if __name__ == '__main__':
         words = sorted(list(set(word_text.strip().split(' '))))
     print(words)
 
-    solver = SubstitutionCipherSolver(cipher_text, words)
+    solver = SubstitutionCipherSolver(cipher_text, words,
+                                      telemetry=GenerationTelemetry(callback=GenerationTelemetry.print_record))
     # print('Testing functions...')
     # print(solver.swap('abcdef'))
     # print(solver.shuffle('1234567890'))